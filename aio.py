@@ -0,0 +1,240 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from bahn import CLASSES
+from bahn import STREAM_MIN
+from bahn import AnswerBuilder
+from bahn import ijson
+from bahn import load_answer
+from bahn import parse_psc
+from bahn import psc_valid_until
+from bahn import search_params
+from db import Connection
+from db import dest_group
+from db import start_group
+from db import station_ids
+from db import User
+from metrics import span
+from router import DEST
+from router import FETCH
+from router import IMPORT
+from router import START
+from stations import normalize
+from stations import parse_station
+from stations import station_params
+from watchlist import is_import
+from watchlist import parse_watchlist
+from watchlist import station_names
+from watchlist import strip_command
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncFareClient(object):
+    # asyncio counterpart of FareClient, sharing its cache and price observer
+    def __init__(self, fares, limit=20, timeout=10, connect_timeout=3):
+        self.fares = fares
+        self.limit = limit
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.http = None
+        self._psc = None
+        self._psc_valid_until = 0
+        self._psc_lock = None
+
+    async def open(self):
+        self.http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.limit),
+                                          timeout=aiohttp.ClientTimeout(total=self.timeout,
+                                                                        sock_connect=self.connect_timeout))
+        self._psc_lock = asyncio.Lock()
+
+    async def close(self):
+        await self.http.close()
+
+    async def pscexpires(self, refresh=False):
+        async with self._psc_lock:
+            now = time.time()
+            scraped = refresh or self._psc is None or now >= self._psc_valid_until
+            if scraped:
+                with span("psc_scrape"):
+                    async with self.fares.upstream.request_async(), \
+                            self.http.post(self.fares.base_url + "psc_angebotssuche.post?lang=de&country=DEU") as r:
+                        r.raise_for_status()
+                        self._psc = parse_psc(await r.text())
+                self._psc_valid_until = psc_valid_until(self._psc, now)
+            return self._psc, scraped
+
+    async def query(self, start, dest, day, klass, psc):
+        with span("fare_query", klass=klass):
+            async with self.fares.upstream.request_async(), \
+                    self.http.get(self.fares.base_url + "psc_service.go", allow_redirects=False,
+                                  params=search_params(start, dest, day, klass, psc)) as r:
+                r.raise_for_status()
+                if ijson is None or (r.content_length or STREAM_MIN) < STREAM_MIN:
+                    return load_answer(await r.read())
+                builder = AnswerBuilder()
+                async for event in ijson.parse_async(r.content):
+                    builder.feed(*event)
+                return builder.result
+
+    async def query_all(self, start, dest, day, classes=CLASSES):
+        psc, scraped = await self.pscexpires()
+        results = await asyncio.gather(*[self.query(start, dest, day, klass, psc) for klass in classes])
+        if not scraped and any("error" in res for res in results):
+            # the cached token may have run out early, so try once more with a fresh one
+            psc, scraped = await self.pscexpires(refresh=True)
+            results = await asyncio.gather(*[self.query(start, dest, day, klass, psc) for klass in classes])
+        return results
+
+    async def fetch(self, start, dest, day):
+        with span("fare_fetch"):
+            cached, missing = self.fares.from_cache(start, dest, day)
+            results = await self.query_all(start, dest, day, missing) if missing else []
+            return self.fares.remember(start, dest, day, cached, missing, results)
+
+
+class AsyncStationFinder(object):
+    # asks ajax-getstop.exe without blocking a thread and fills the station cache of StationFinder
+    def __init__(self, stations, client, executor):
+        self.stations = stations
+        self.client = client
+        self.executor = executor
+
+    async def find(self, name):
+        key = normalize(name)
+        loop = asyncio.get_event_loop()
+        if not key or await loop.run_in_executor(self.executor, self.stations.known, key):
+            return
+        with span("station_remote"):
+            async with self.stations.upstream.request_async(), \
+                    self.client.http.get(self.stations.url, params=station_params(name)) as r:
+                r.raise_for_status()
+                found = parse_station(await r.text())
+        await loop.run_in_executor(self.executor, self.stations.remember, key, found)
+
+
+class AsyncRuntime(object):
+    # Runs the network I/O of an update as a coroutine and only hands the database work of Gate to a
+    # small thread pool. Gate then finds fares and stations in the caches and never waits on the network.
+    # The updates of one chat are handled one after another and in order, like in the lanes of RunWorker.
+    def __init__(self, gate, session_factory, fares, stations, router, db_workers=4, limit=20, timeout=10):
+        if aiohttp is None:
+            raise RuntimeError("Runtime=asyncio needs the aiohttp package")
+        self.gate = gate
+        self.router = router
+        self.session_factory = session_factory
+        self.executor = ThreadPoolExecutor(max_workers=db_workers)
+        self.fares = AsyncFareClient(fares, limit=limit, timeout=timeout)
+        self.stations = AsyncStationFinder(stations, self.fares, self.executor)
+        self.loop = asyncio.new_event_loop()
+        # chat id -> [lock, number of its updates in handle], only touched in the loop thread
+        self.chats = {}
+        self.thread = threading.Thread(target=self.run, name="asyncio", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.fares.open(), self.loop).result()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.fares.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.executor.shutdown(wait=True)
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, bot, update):
+        # used as handler callback, returns at once so the dispatcher thread is free for the next update
+        return asyncio.run_coroutine_threadsafe(self.handle(bot, update), self.loop)
+
+    async def handle(self, bot, update):
+        # the lock is taken before the first await and asyncio.Lock wakes its waiters in order, so the updates of
+        # a chat run in the order they were submitted
+        chat = update.effective_chat
+        key = chat.id if chat is not None else None
+        entry = self.chats.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                try:
+                    await self.prepare(update)
+                except Exception:
+                    logger.warning("Prefetching for update %s failed", update.update_id, exc_info=True)
+                try:
+                    await self.loop.run_in_executor(self.executor, self.gate, bot, update)
+                except Exception:
+                    logger.exception("Handling update %s failed", update.update_id)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.chats[key]
+
+    async def prepare(self, update):
+        if update.callback_query is not None:
+            try:
+                payload = self.router.decode(update.callback_query.data)
+            except ValueError:
+                return
+            if payload.action == FETCH:
+                route = await self.loop.run_in_executor(self.executor, self.route,
+                                                        update.callback_query.message.chat.id, payload)
+                if route is not None:
+                    # every pair of a station group at once, Gate then merges them from the cache
+                    starts, dests, day = route
+                    results = await asyncio.gather(*[self.fares.fetch(start, dest, day) for start in starts
+                                                     for dest in dests if start != dest], return_exceptions=True)
+                    for result in results:
+                        if isinstance(result, Exception):
+                            logger.warning("Prefetching fares for update %s failed: %r", update.update_id, result)
+        elif update.message is not None and update.message.text:
+            if is_import(update.message.text):
+                await self.find_all(strip_command(update.message.text))
+                return
+            selection = await self.loop.run_in_executor(self.executor, self.selection, update.message.chat.id)
+            try:
+                payload = self.router.decode(selection or "")
+            except ValueError:
+                return
+            if payload.action in (START, DEST):
+                await self.stations.find(update.message.text)
+            elif payload.action == IMPORT:
+                await self.find_all(update.message.text)
+
+    async def find_all(self, text):
+        # all stations of a watch list at once, the upstream guard still bounds how many run in parallel
+        watches, errors = parse_watchlist(text, date.today())
+        if not errors:
+            # a failed name is looked up again by the handler, it must not hide the others
+            await asyncio.gather(*[self.stations.find(name) for name in station_names(watches)],
+                                 return_exceptions=True)
+
+    def route(self, chat_id, payload):
+        s = self.session_factory()
+        try:
+            conn = s.query(Connection).filter(Connection.user_id == chat_id, Connection.id == payload.target).first()
+            if conn is None:
+                return None
+            return station_ids(start_group(conn)), station_ids(dest_group(conn)), payload.extra or conn.date
+        finally:
+            s.close()
+
+    def selection(self, chat_id):
+        s = self.session_factory()
+        try:
+            user = s.query(User).filter(User.id == chat_id).first()
+            return user.current_selection if user is not None else None
+        finally:
+            s.close()
@@ -0,0 +1,405 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import json
+import logging
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+from metrics import REGISTRY
+from metrics import span
+from upstream import Upstream
+
+BASE_URL = "https://ps.bahn.de/preissuche/preissuche/"
+# used when the pscExpires value can't be interpreted as a timestamp
+PSC_TTL = 600
+CLASSES = ("2", "1")
+# the only fields of a psc_service.go answer the fares are built from, the keys of verbindungen and angebote are ids
+KEEP = {"verbindungen", "angebote", "trains", "dep", "arr", "tn", "t", "dur", "p", "sids", "error"}
+# answers from this size on (or of unknown size) are streamed with ijson, which saves memory but takes longer
+STREAM_MIN = 512 * 1024
+# shown instead of the fares when the Bahn can't be reached and nothing usable is cached
+UNAVAILABLE = "Die Sparpreissuche ist gerade nicht erreichbar. Bitte versuche es später nochmal."
+# failures of a lookup that are the fault of the Bahn servers: network, timeouts, HTTP errors and broken answers
+UPSTREAM_ERRORS = (requests.RequestException, ValueError, KeyError, IndexError) + (
+    (ijson.JSONError,) if ijson is not None else ())
+
+logger = logging.getLogger(__name__)
+cache_lookups = REGISTRY.counter("fare_cache_lookups_total", "Fare cache lookups per class and result")
+stale_served = REGISTRY.counter("fare_stale_total", "Lookups answered with expired cache entries")
+
+
+def timetomin(s):
+    (h, m) = s.split(":")
+    return int(h) * 60 + int(m)
+
+
+# train is the number of the first train (e.g. "ICE 597"), None if the answer has none
+Fare = namedtuple("Fare", ["start_time", "arrival_time", "duration", "changes", "price", "klass", "train"])
+# a fare of a station group search, with the ext ids of the stations it was found for
+RouteFare = namedtuple("RouteFare", Fare._fields + ("start", "dest"))
+# what is kept of a connection of the answer
+Leg = namedtuple("Leg", ["start_time", "arrival_time", "duration", "changes", "train"])
+
+
+def parse_psc(html):
+    # BeautifulSoup and lxml are only needed here and take a while to import, so load them on first use
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, "lxml")
+    inp = soup.select("#pscExpires")
+    return inp[0].attrs["value"]
+
+
+def reduce_object(obj):
+    # connections become a Leg, trains (departure, arrival, number), stops their time and offers (price, sids),
+    # so a decoded answer only holds what the fares are built from
+    if "verbindungen" in obj or "error" in obj:
+        return obj
+    if "trains" in obj:
+        trains = obj["trains"]
+        return Leg(trains[0][0], trains[-1][1], timetomin(obj["dur"]), len(trains) - 1, trains[0][2])
+    if "dep" in obj:
+        return obj["dep"], obj["arr"], obj.get("tn")
+    if "sids" in obj:
+        return Decimal(obj["p"].replace(",", ".")), parse_sids(obj["sids"])
+    if "t" in obj:
+        return obj["t"]
+    return obj
+
+
+def compact(pairs):
+    # object_pairs_hook for json.loads, unused fields are dropped as soon as their object is decoded
+    return reduce_object({key: value for key, value in pairs if key in KEEP or key.isdigit()})
+
+
+def load_answer(data):
+    return json.loads(data, object_pairs_hook=compact)
+
+
+class AnswerBuilder(object):
+    # builds the same compact answer from ijson events, unused fields are skipped without being built
+    def __init__(self):
+        # containers being built with their key in the parent
+        self.stack = []
+        self.key = None
+        # depth inside a skipped container, and whether the next value belongs to a skipped key
+        self.skip = 0
+        self.drop = False
+        self.result = None
+
+    def feed(self, prefix, event, value):
+        if self.skip:
+            if event in ("start_map", "start_array"):
+                self.skip += 1
+            elif event in ("end_map", "end_array"):
+                self.skip -= 1
+            return
+        if self.drop:
+            self.drop = False
+            if event in ("start_map", "start_array"):
+                self.skip = 1
+            return
+        if event == "map_key":
+            self.key = value
+            self.drop = not (value in KEEP or value.isdigit())
+        elif event == "start_map":
+            self.stack.append((dict(), self.key))
+        elif event == "start_array":
+            self.stack.append(([], self.key))
+        elif event == "end_map":
+            obj, self.key = self.stack.pop()
+            self.add(reduce_object(obj))
+        elif event == "end_array":
+            obj, self.key = self.stack.pop()
+            self.add(obj)
+        else:
+            self.add(value)
+
+    def add(self, value):
+        if not self.stack:
+            self.result = value
+        elif type(self.stack[-1][0]) is list:
+            self.stack[-1][0].append(value)
+        else:
+            self.stack[-1][0][self.key] = value
+
+
+def stream_answer(fp):
+    # reads the answer from a file-like object chunk by chunk instead of loading the whole text
+    builder = AnswerBuilder()
+    for event in ijson.parse(fp):
+        builder.feed(*event)
+    return builder.result
+
+
+def search_params(start, dest, day, klass, psc):
+    return {'lang': 'de', 'country': 'DEU', 'service': 'pscangebotsuche',
+            "data": json.dumps({"s": start, "d": dest, "dt": day.strftime("%d.%m.%y"), "t": "0:00", "dur": 1440,
+                                "pscexpires": psc, "dir": 1, "sv": True, "ohneICE": False, "bic": False,
+                                "tct": "0", "c": klass, "travellers": [{"typ": "E", "bc": "0", "alter": ""}]},
+                               separators=(",", ":"))}
+
+
+def parse_sids(sids):
+    # sids is normally a list of connection ids, but accept a comma separated string as well
+    if isinstance(sids, str):
+        return [sid.strip() for sid in sids.split(",") if sid.strip()]
+    return [str(sid) for sid in sids]
+
+
+def cheapest_offers(angebote):
+    # connection id -> lowest price of all offers valid for it
+    prices = dict()
+    for price, sids in angebote.values():
+        for sid in sids:
+            if sid not in prices or price < prices[sid]:
+                prices[sid] = price
+    return prices
+
+
+def parse_fares(res, klass):
+    # res is a compact answer as returned by load_answer or stream_answer
+    prices = cheapest_offers(res["angebote"])
+    return [Fare(leg.start_time, leg.arrival_time, leg.duration, leg.changes, prices.get(sid, 0), klass, leg.train)
+            for sid, leg in res["verbindungen"].items()]
+
+
+def matches(fare, connection):
+    return fare.changes <= connection.maxchanges and fare.price <= connection.maxprice and \
+        fare.duration <= connection.maxduration
+
+
+def bucket_fares(fares, connection, connections):
+    # price -> list of fares within the limits of the connection
+    for fare in fares:
+        if matches(fare, connection):
+            connections.setdefault(fare.price, []).append(fare)
+    return connections
+
+
+def rank(fare):
+    # fares without an offer (price 0) last, then the cheapest and the fastest
+    return fare.price == 0, fare.price, fare.duration
+
+
+def merge_fares(pairs, results):
+    # fares of several (start, dest) pairs as one price sorted list. A train leaving the same station at the same
+    # time was found for more than one destination, only its cheapest fare is kept. The error of a pair is only
+    # returned if no pair has fares.
+    best = dict()
+    error = None
+    for (start, dest), fares in zip(pairs, results):
+        if type(fares) is str:
+            error = fares
+            continue
+        for fare in fares:
+            fare = RouteFare(*(fare + (start, dest)))
+            key = (start, fare.start_time, fare.train, fare.klass)
+            if key not in best or rank(fare) < rank(best[key]):
+                best[key] = fare
+    if not best and error is not None:
+        return error
+    return sorted(best.values(), key=rank)
+
+
+class FareClient(object):
+    def __init__(self, base_url=BASE_URL, workers=4, cache=None, observer=None, range_workers=4, upstream=None,
+                 max_stale=6 * 3600, group_workers=4):
+        self.base_url = base_url
+        self.upstream = upstream if upstream is not None else Upstream("ps.bahn.de", concurrency=workers)
+        # how old cached fares may be that are shown while the Bahn can't be reached
+        self.max_stale = max_stale
+        # unfiltered fares per (start, dest, date, class)
+        self.cache = cache
+        # called with (start, dest, day, fares) for every fresh upstream result
+        self.observer = observer
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.prefetcher = ThreadPoolExecutor(max_workers=1)
+        # days of a range search, a separate pool so they can't starve the class queries they wait for
+        self.ranger = ThreadPoolExecutor(max_workers=range_workers)
+        # station pairs of group searches, shared by all of them and separate from the pools they wait for
+        self.grouper = ThreadPoolExecutor(max_workers=group_workers)
+        self._psc = None
+        self._psc_valid_until = 0
+        self._psc_lock = threading.Lock()
+
+    def _scrape_psc(self):
+        with self.upstream.request() as timeout:
+            search = self.session.post(self.base_url + "psc_angebotssuche.post?lang=de&country=DEU", timeout=timeout)
+            search.raise_for_status()
+            return parse_psc(search.text)
+
+    def pscexpires(self, refresh=False):
+        # the token is shared by all lookups until it runs out, so only one thread has to scrape it
+        with self._psc_lock:
+            now = time.time()
+            scraped = refresh or self._psc is None or now >= self._psc_valid_until
+            if scraped:
+                with span("psc_scrape"):
+                    self._psc = self._scrape_psc()
+                self._psc_valid_until = psc_valid_until(self._psc, now)
+            return self._psc, scraped
+
+    def query(self, start, dest, day, klass, psc):
+        with span("fare_query", klass=klass), self.upstream.request() as timeout:
+            results = self.session.get(self.base_url + "psc_service.go", stream=True, timeout=timeout,
+                                       params=search_params(start, dest, day, klass, psc), allow_redirects=False)
+            with results:
+                results.raise_for_status()
+                if ijson is not None and int(results.headers.get("Content-Length") or STREAM_MIN) >= STREAM_MIN:
+                    results.raw.decode_content = True
+                    return stream_answer(results.raw)
+                return load_answer(results.content)
+
+    def query_all(self, start, dest, day, classes=CLASSES):
+        # all classes are requested at the same time, results are returned in the order of classes
+        psc, scraped = self.pscexpires()
+        futures = [self.executor.submit(self.query, start, dest, day, klass, psc) for klass in classes]
+        results = [f.result() for f in futures]
+        if not scraped and any("error" in res for res in results):
+            # the cached token may have run out early, so try once more with a fresh one
+            psc, scraped = self.pscexpires(refresh=True)
+            futures = [self.executor.submit(self.query, start, dest, day, klass, psc) for klass in classes]
+            results = [f.result() for f in futures]
+        return results
+
+    def fetch(self, start, dest, day, stale=True):
+        # all fares of both classes for the day without any filter, or the error message of the search;
+        # with stale, expired cached fares are returned while the Bahn can't be reached
+        with span("fare_fetch"):
+            cached, missing = self.from_cache(start, dest, day)
+            try:
+                results = self.query_all(start, dest, day, missing) if missing else []
+            except UPSTREAM_ERRORS as e:
+                logger.warning("Looking up %s - %s on %s failed: %r", start, dest, day, e)
+                return self.fallback(start, dest, day, cached, missing) if stale else UNAVAILABLE
+            return self.remember(start, dest, day, cached, missing, results)
+
+    def fetch_group(self, starts, dests, day, stale=True):
+        # every start with every destination at the same time, merged by merge_fares; a single pair is
+        # fetched directly and keeps plain fares
+        pairs = [(start, dest) for start in starts for dest in dests if start != dest]
+        if len(pairs) == 1:
+            return self.fetch(pairs[0][0], pairs[0][1], day, stale)
+        with span("fare_group"):
+            futures = [self.grouper.submit(self.fetch, start, dest, day, stale) for start, dest in pairs]
+            return merge_fares(pairs, [f.result() for f in futures])
+
+    def fallback(self, start, dest, day, cached, missing):
+        if self.cache is None:
+            return UNAVAILABLE
+        for klass in missing:
+            fares = self.cache.stale((start, dest, day, klass), self.max_stale)
+            if fares is None:
+                return UNAVAILABLE
+            cached[klass] = fares
+        stale_served.inc()
+        fares = []
+        for klass in CLASSES:
+            fares.extend(cached[klass])
+        return fares
+
+    def from_cache(self, start, dest, day):
+        cached = dict()
+        if self.cache is not None:
+            for klass in CLASSES:
+                fares = self.cache.get((start, dest, day, klass))
+                cache_lookups.inc(klass=klass, result="miss" if fares is None else "hit")
+                if fares is not None:
+                    cached[klass] = fares
+        return cached, [klass for klass in CLASSES if klass not in cached]
+
+    def remember(self, start, dest, day, cached, classes, results):
+        # parses fresh results into the cache and joins them with the cached classes
+        for klass, res in zip(classes, results):
+            if "error" in res:
+                # the error object is reduced to its message like any other object with a "t"
+                return res["error"]
+            with span("fare_parse", klass=klass):
+                cached[klass] = parse_fares(res, klass)
+            if self.cache is not None:
+                self.cache.put((start, dest, day, klass), cached[klass])
+            if self.observer is not None:
+                self.observer(start, dest, day, cached[klass])
+        fares = []
+        for klass in CLASSES:
+            fares.extend(cached[klass])
+        return fares
+
+    def prefetch(self, start, dest, days):
+        # warm the cache for days the user is likely to look at next
+        if self.cache is None:
+            return
+        for day in days:
+            if any((start, dest, day, klass) not in self.cache for klass in CLASSES):
+                self.prefetcher.submit(self._prefetch, start, dest, day)
+
+    def _prefetch(self, start, dest, day):
+        try:
+            self.fetch(start, dest, day)
+        except Exception:
+            logger.exception("Prefetching %s - %s on %s failed", start, dest, day)
+
+    def fetch_range(self, starts, dests, days, callback):
+        # looks up all days without waiting for them, callback(day, fares) runs as soon as a day is done;
+        # cached days are answered right away
+        for day in days:
+            future = self.ranger.submit(self.fetch_group, starts, dests, day)
+            future.add_done_callback(lambda future, day=day: self._fetched(callback, day, future))
+
+    def _fetched(self, callback, day, future):
+        try:
+            fares = future.result()
+        except Exception:
+            logger.exception("Fetching %s failed", day)
+            fares = "Abfrage fehlgeschlagen"
+        try:
+            callback(day, fares)
+        except Exception:
+            logger.exception("Handling the result for %s failed", day)
+
+    def reqcons(self, connection, starts=None, dests=None):
+        # starts and dests are the ext ids of a station group, searched instead of those of the connection
+        return filter_fares(self.fetch_group(starts or [connection.start], dests or [connection.dest],
+                                             connection.date), connection)
+
+
+def filter_fares(fares, connection):
+    if type(fares) is str:
+        return fares
+    return bucket_fares(fares, connection, dict())
+
+
+def cheapest_fare(fares, connection):
+    # lowest price within the limits of the connection, None if there is none, or the error message
+    if type(fares) is str:
+        return fares
+    prices = [fare.price for fare in fares if fare.price > 0 and matches(fare, connection)]
+    return min(prices) if prices else None
+
+
+def psc_valid_until(psc, now):
+    # pscExpires is an epoch timestamp, in seconds or milliseconds; keep a safety margin of a minute
+    try:
+        expires = int(psc)
+    except ValueError:
+        return now + PSC_TTL
+    if expires > 10 ** 11:
+        expires //= 1000
+    if expires <= now:
+        return now + PSC_TTL
+    return expires - 60
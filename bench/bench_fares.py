@@ -0,0 +1,56 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Compares the old sequential reqcons request pattern with FareClient against the local stand-in server.
+# Run from the repository root: python -m bench.bench_fares
+import argparse
+import json
+import statistics
+import time
+from datetime import date
+from types import SimpleNamespace
+
+import requests
+from bs4 import BeautifulSoup
+
+from bahn import FareClient
+from bench.fakebahn import FakeBahn
+from bench.fakebahn import unlimited
+
+
+def sequential(base_url, connection):
+    # the request pattern reqcons used before: scrape, 2nd class, 1st class, one after another
+    search = requests.post(base_url + "psc_angebotssuche.post?lang=de&country=DEU")
+    psc = BeautifulSoup(search.text, "lxml").select("#pscExpires")[0].attrs["value"]
+    for klass in ("2", "1"):
+        d = {'lang': 'de', 'country': 'DEU', 'service': 'pscangebotsuche',
+             "data": json.dumps({"s": connection.start, "d": connection.dest, "dt": "01.01.30", "t": "0:00",
+                                 "dur": 1440, "pscexpires": psc, "c": klass})}
+        requests.get(base_url + "psc_service.go", params=d, allow_redirects=False).json()
+
+
+def measure(fn, rounds):
+    timings = []
+    for _ in range(rounds):
+        t = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - t) * 1000)
+    return statistics.median(timings), max(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency", type=float, default=0.05, help="upstream latency per request in seconds")
+    parser.add_argument("--rounds", type=int, default=20)
+    opts = parser.parse_args()
+    connection = SimpleNamespace(start="8000261", dest="8011160", date=date(2030, 1, 1), maxchanges=10,
+                                 maxprice=200, maxduration=3000)
+    with FakeBahn(latency=opts.latency) as fake:
+        before = measure(lambda: sequential(fake.url, connection), opts.rounds)
+        client = FareClient(base_url=fake.url, upstream=unlimited())
+        after = measure(lambda: client.reqcons(connection), opts.rounds)
+    print("sequential   median %7.1f ms  max %7.1f ms" % before)
+    print("FareClient   median %7.1f ms  max %7.1f ms" % after)
+
+
+if __name__ == "__main__":
+    main()
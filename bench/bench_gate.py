@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# End-to-end benchmark of the update handlers: synthetic users click through the bot while Gate talks to local
+# stand-ins for the Bahn servers and the Telegram Bot API.
+# Run from the repository root: python -m bench.bench_gate [--users 200] [--workers 4] [--latency 0.05]
+import argparse
+import logging
+import os
+import queue
+import statistics
+import tempfile
+import threading
+import time
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+
+import telegram
+from sqlalchemy import event
+
+import daemon
+from bench.fakebahn import FakeBahn
+from bench.faketelegram import FakeTelegram
+from db import Connection
+from db import User
+from ratelimit import RateLimiter
+from router import FETCH
+from router import HOME
+from router import PRICE
+from router import SHOW
+from router import START
+from router import encode
+
+STATIONS = ["München Hbf", "Berlin Hbf", "Hamburg Hbf", "Köln Hbf", "Frankfurt(Main)Hbf", "Stuttgart Hbf",
+            "Düsseldorf Hbf", "Leipzig Hbf", "Dresden Hbf", "Hannover Hbf", "Nürnberg Hbf", "Bremen Hbf"]
+ROUTES = [("8000261", "8011160"), ("8002549", "8000207"), ("8000105", "8000096"), ("8000152", "8010205")]
+
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, *args):
+        with self.lock:
+            self.value += 1
+
+
+def populate(users, day):
+    # every user already watches one connection, routes are shared so the fare cache gets hits
+    s = daemon.SessionFactory()
+    s.bulk_save_objects([User(id=i, counter=0, current_selection="0", first_name="Bench") for i in range(1, users + 1)])
+    s.bulk_save_objects([Connection(id=i, user_id=i, date=day, start=ROUTES[i % len(ROUTES)][0], start_name="Start",
+                                    dest=ROUTES[i % len(ROUTES)][1], dest_name="Ziel")
+                         for i in range(1, users + 1)])
+    s.commit()
+    s.close()
+
+
+def script(chat_id, day):
+    # (callback data, None) or (None, text) in the order one user sends them
+    conn_id = chat_id
+    return [(None, "/start"), (encode(HOME), None), (encode(SHOW, conn_id), None), (encode(FETCH, conn_id), None),
+            (encode(FETCH, conn_id, day + timedelta(1)), None), (encode(PRICE, conn_id), None), (None, "49,90"),
+            (encode(START, -1), None), (None, STATIONS[chat_id % len(STATIONS)]),
+            (None, STATIONS[(chat_id * 7 + 3) % len(STATIONS)])]
+
+
+def make_update(update_id, chat_id, data, text):
+    chat = telegram.Chat(chat_id, "private", first_name="Bench")
+    user = telegram.User(chat_id, "Bench", False)
+    if data is None:
+        message = telegram.Message(message_id=update_id, from_user=user, date=datetime.now(), chat=chat, text=text)
+        return telegram.Update(update_id, message=message)
+    message = telegram.Message(message_id=1, from_user=user, date=datetime.now(), chat=chat, text="")
+    return telegram.Update(update_id, callback_query=telegram.CallbackQuery(str(update_id), user, str(chat_id),
+                                                                            message=message, data=data))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=4, help="dispatcher threads")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per Bahn request")
+    parser.add_argument("--telegram-latency", type=float, default=0.02, help="seconds per Bot API request")
+    parser.add_argument("--recorded", help="directory with recorded psc_service.json and ajax-getstop.txt")
+    parser.add_argument("--no-prefetch", action="store_true")
+    opts = parser.parse_args()
+    workdir = tempfile.mkdtemp()
+    path = os.path.join(workdir, "config.ini")
+    with open(path, "w") as f:
+        # no upstream throttling, the stand-ins answer as fast as the latency allows
+        f.write("[DEFAULT]\nBotToken=123456:bench\nDatabase=sqlite:///%s\nPrefetch=%s\nUpstreamRate=10000000\n"
+                "UpstreamConcurrency=256\n" % (os.path.join(workdir, "bench.sqlite"), "no" if opts.no_prefetch else "yes"))
+
+    with FakeBahn(latency=opts.latency, recorded=opts.recorded) as bahn, \
+            FakeTelegram(latency=opts.telegram_latency) as api:
+        daemon.init(path=path, bot=telegram.Bot("123456:bench", base_url=api.url))
+        daemon.fares.base_url = bahn.url
+        daemon.stations.url = bahn.station_url
+        # the stand-in has no flood limits, let the outbox deliver as fast as it can so every call is counted
+        daemon.outbox.chat_interval = 0
+        daemon.outbox.limiter = RateLimiter(10 ** 6, burst=10 ** 6)
+        day = date.today() + timedelta(7)
+        populate(opts.users, day)
+        transactions = Counter()
+        event.listen(daemon.engine, "begin", transactions)
+        daemon.outbox.start()
+
+        users = queue.Queue()
+        for chat_id in range(1, opts.users + 1):
+            users.put(chat_id)
+        latencies = []
+        errors = Counter()
+        lock = threading.Lock()
+
+        def worker():
+            # updates of one chat are handled one after the other, different chats in parallel
+            while True:
+                try:
+                    chat_id = users.get_nowait()
+                except queue.Empty:
+                    return
+                for number, (data, text) in enumerate(script(chat_id, day)):
+                    update = make_update(chat_id * 100 + number, chat_id, data, text)
+                    t = time.perf_counter()
+                    try:
+                        daemon.Gate(None, update)
+                    except Exception:
+                        errors()
+                        logging.exception("Update %r failed", data or text)
+                    with lock:
+                        latencies.append((time.perf_counter() - t) * 1000)
+
+        threads = [threading.Thread(target=worker) for _ in range(opts.workers)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        daemon.fares.prefetcher.shutdown(wait=True)
+        while daemon.outbox.stats()["depth"] and time.perf_counter() - start < elapsed + 30:
+            time.sleep(0.05)
+        daemon.outbox.stop()
+
+    updates = len(latencies)
+    latencies.sort()
+    print("%d updates from %d users in %.1f s: %.0f updates/s, %d errors" % (
+        updates, opts.users, elapsed, updates / elapsed, errors.value))
+    print("latency p50 %.1f ms, p99 %.1f ms, max %.1f ms" % (
+        statistics.median(latencies), latencies[int(updates * 0.99) - 1], latencies[-1]))
+    print("per update: %.2f Bahn requests (%s), %.2f DB transactions, %.2f Telegram calls" % (
+        bahn.upstream_calls / updates, ", ".join("%s %d" % item for item in sorted(bahn.calls.items())),
+        transactions.value / updates, api.total / updates))
+    print("fare cache hit rate %.0f%%" % (daemon.fares.cache.stats()["hit_rate"] * 100))
+
+
+if __name__ == "__main__":
+    main()
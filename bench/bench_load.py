@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Load test of the database work a handler does per update (CheckUser + ShowHome), with thousands of users.
+# Run from the repository root: python -m bench.bench_load [--users 5000] [--plain]
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+from datetime import date
+from datetime import timedelta
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session
+from sqlalchemy.orm import sessionmaker
+
+from db import Base
+from db import Connection
+from db import User
+from db import create_db_engine
+from db import migrate
+
+
+def populate(engine, users, per_user):
+    s = sessionmaker(bind=engine)()
+    today = date.today()
+    s.bulk_save_objects([User(id=i, counter=0, current_selection="0") for i in range(users)])
+    s.bulk_save_objects([Connection(user_id=i, date=today + timedelta(random.randrange(-60, 60)), start="8000261",
+                                    start_name="München Hbf", dest="8011160", dest_name="Berlin Hbf",
+                                    notifications=random.randrange(3))
+                         for i in range(users) for _ in range(per_user)])
+    s.commit()
+    s.close()
+
+
+def update(DBSession, user_id):
+    s = DBSession()
+    try:
+        usr = s.query(User).filter(User.id == user_id).first()
+        usr.counter += 1
+        usr.current_selection = "0"
+        s.query(Connection).filter(Connection.user_id == usr.id, Connection.date >= date.today()).all()
+        s.commit()
+    finally:
+        DBSession.remove()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--connections", type=int, default=5, help="connections per user")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--updates", type=int, default=4000)
+    parser.add_argument("--plain", action="store_true", help="default engine without indexes and pragmas")
+    opts = parser.parse_args()
+    url = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "load.sqlite")
+    if opts.plain:
+        engine = create_engine(url, connect_args={'check_same_thread': False})
+        Base.metadata.create_all(engine)
+        for index in Connection.__table__.indexes:
+            index.drop(engine)
+    else:
+        engine = create_db_engine(url)
+        migrate(engine)
+    populate(engine, opts.users, opts.connections)
+    DBSession = scoped_session(sessionmaker(bind=engine, autoflush=False))
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(count):
+        for _ in range(count):
+            t = time.perf_counter()
+            update(DBSession, random.randrange(opts.users))
+            with lock:
+                latencies.append((time.perf_counter() - t) * 1000)
+
+    threads = [threading.Thread(target=worker, args=(opts.updates // opts.threads,)) for _ in range(opts.threads)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print("%s: %d updates, %.0f/s, p50 %.2f ms, p99 %.2f ms" % (
+        "plain" if opts.plain else "tuned", len(latencies), len(latencies) / elapsed,
+        statistics.median(latencies), latencies[int(len(latencies) * 0.99) - 1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Peak memory and time of turning a psc_service.go answer into fares: the full json tree as before, the compact
+# json.loads hook and the ijson stream.
+# Run from the repository root: python -m bench.bench_memory [recorded.json ...]
+import argparse
+import io
+import json
+import time
+import tracemalloc
+from decimal import Decimal
+
+from bahn import Fare
+from bahn import ijson
+from bahn import load_answer
+from bahn import parse_fares
+from bahn import stream_answer
+from bahn import timetomin
+from bench.fakebahn import make_response
+
+
+def full(data, klass):
+    # the whole answer as nested dicts, the way reqcons used to decode it
+    res = json.loads(data)
+    prices = dict()
+    for offer in res["angebote"].values():
+        price = Decimal(offer["p"].replace(",", "."))
+        for sid in offer["sids"]:
+            if sid not in prices or price < prices[sid]:
+                prices[sid] = price
+    return [Fare(v["trains"][0]["dep"]["t"], v["trains"][-1]["arr"]["t"], timetomin(v["dur"]), len(v["trains"]) - 1,
+                 prices.get(sid, 0), klass, v["trains"][0].get("tn")) for sid, v in res["verbindungen"].items()]
+
+
+def measure(parse, data):
+    # tracemalloc slows everything down, so time a separate run
+    started = time.perf_counter()
+    parse(data)
+    elapsed = time.perf_counter() - started
+    tracemalloc.start()
+    fares = parse(data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak, elapsed, len(fares)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("recorded", nargs="*", help="recorded psc_service.go responses")
+    opts = parser.parse_args()
+    if opts.recorded:
+        answers = []
+        for name in opts.recorded:
+            with open(name, "rb") as f:
+                answers.append((name, f.read()))
+    else:
+        answers = [("synthetic %d" % n, json.dumps(make_response(n, detail=True)).encode()) for n in (200, 800, 3200)]
+    methods = [("full", lambda data: full(data, "2")),
+               ("compact", lambda data: parse_fares(load_answer(data), "2"))]
+    if ijson is not None:
+        methods.append(("streamed", lambda data: parse_fares(stream_answer(io.BytesIO(data)), "2")))
+    else:
+        print("ijson is not installed, skipping the streaming parser")
+    for name, data in answers:
+        print("%s, %.0f kB" % (name, len(data) / 1024))
+        for method, parse in methods:
+            peak, elapsed, fares = measure(parse, data)
+            print("  %-8s peak %8.0f kB  %8.1f ms  %d fares" % (method, peak / 1024, elapsed * 1000, fares))
+
+
+if __name__ == "__main__":
+    main()
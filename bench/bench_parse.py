@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Micro-benchmark of the psc_service.go response parsing.
+# Run from the repository root: python -m bench.bench_parse [recorded.json ...]
+import argparse
+import json
+import timeit
+from decimal import Decimal
+from types import SimpleNamespace
+
+from bahn import bucket_fares
+from bahn import load_answer
+from bahn import parse_fares
+from bahn import timetomin
+from bench.fakebahn import make_response
+
+
+def quadratic(res, connection, klass):
+    # the parser reqcons used before, scanning all offers for every connection
+    connections = dict()
+    for i in range(len(res["verbindungen"])):
+        price = 0
+        for j in range(len(res["angebote"])):
+            if str(i) in res["angebote"][str(j)]["sids"]:
+                price = Decimal(res["angebote"][str(j)]["p"].replace(",", "."))
+                break
+        con = {"changes": len(res["verbindungen"][str(i)]["trains"]) - 1,
+               "duration": timetomin(res["verbindungen"][str(i)]["dur"]), "price": price,
+               "start_time": res["verbindungen"][str(i)]["trains"][0]["dep"]["t"],
+               "arrival_time": res["verbindungen"][str(i)]["trains"][-1]["arr"]["t"], "class": klass}
+        if con["changes"] <= connection.maxchanges and con["price"] <= connection.maxprice and con[
+            "duration"] <= connection.maxduration:
+            if con["price"] not in connections:
+                connections.update({con["price"]: [con]})
+            else:
+                connections.update({con["price"]: connections[con["price"]] + [con]})
+    return connections
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("recorded", nargs="*", help="recorded psc_service.go responses")
+    parser.add_argument("--number", type=int, default=20)
+    opts = parser.parse_args()
+    connection = SimpleNamespace(maxchanges=10, maxprice=Decimal(200), maxduration=3000)
+    if opts.recorded:
+        responses = []
+        for name in opts.recorded:
+            with open(name, "rb") as f:
+                responses.append((name, f.read()))
+    else:
+        responses = [("synthetic %d" % n, json.dumps(make_response(n)).encode()) for n in (50, 200, 800)]
+    for name, data in responses:
+        # both include decoding the answer
+        old = timeit.timeit(lambda: quadratic(json.loads(data), connection, "2"), number=opts.number) / opts.number
+        new = timeit.timeit(lambda: bucket_fares(parse_fares(load_answer(data), "2"), connection, {}),
+                            number=opts.number) / opts.number
+        print("%-20s %5d connections  old %8.3f ms  new %8.3f ms" % (
+            name, len(json.loads(data)["verbindungen"]), old * 1000, new * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Concurrent "Jetzt abrufen" lookups per second in thread-pool and asyncio mode against the local stand-in server.
+# Run from the repository root: python -m bench.bench_runtime [--updates 200] [--latency 0.2]
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from datetime import timedelta
+
+from aio import AsyncFareClient
+from bahn import FareClient
+from bench.fakebahn import FakeBahn
+from bench.fakebahn import unlimited
+from cache import TTLCache
+
+
+def threads(url, days, workers):
+    # the Updater runs handlers in a pool of worker threads that block on every lookup
+    fares = FareClient(base_url=url, cache=TTLCache(size=len(days) * 2), upstream=unlimited())
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(lambda day: fares.fetch("8000261", "8011160", day), days))
+
+
+def asyncio_mode(url, days, limit):
+    async def run():
+        client = AsyncFareClient(FareClient(base_url=url, cache=TTLCache(size=len(days) * 2), upstream=unlimited()), limit=limit)
+        await client.open()
+        try:
+            await asyncio.gather(*[client.fetch("8000261", "8011160", day) for day in days])
+        finally:
+            await client.close()
+
+    asyncio.run(run())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--workers", type=int, default=4, help="dispatcher worker threads")
+    parser.add_argument("--limit", type=int, default=20, help="asyncio connection pool size")
+    opts = parser.parse_args()
+    days = [date(2030, 1, 1) + timedelta(i) for i in range(opts.updates)]
+    with FakeBahn(latency=opts.latency) as fake:
+        for name, run in (("threads", lambda: threads(fake.url, days, opts.workers)),
+                          ("asyncio", lambda: asyncio_mode(fake.url, days, opts.limit))):
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+            print("%-8s %d lookups in %.2f s, %.1f/s" % (name, opts.updates, elapsed, opts.updates / elapsed))
+
+
+if __name__ == "__main__":
+    main()
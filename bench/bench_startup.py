@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Cold start of the bot: importing daemon and init() with a stand-in bot, each run in a fresh interpreter.
+# Run from the repository root: python -m bench.bench_startup [--runs 5]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+CHILD = """
+import json, os, sys, time
+started = time.perf_counter()
+sys.path.insert(0, %r)
+import daemon
+imported = time.perf_counter()
+daemon.init(path=%r, bot=object())
+initialised = time.perf_counter()
+print(json.dumps({"import": imported - started, "init": initialised - imported,
+                  "modules": len(sys.modules), "bs4": "bs4" in sys.modules, "aiohttp": "aiohttp" in sys.modules}))
+"""
+
+
+def run(root, workdir, path):
+    out = subprocess.run([sys.executable, "-c", CHILD % (root, path)], cwd=workdir, check=True,
+                         stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return json.loads(out.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    opts = parser.parse_args()
+    root = os.getcwd()
+    workdir = tempfile.mkdtemp()
+    os.mkdir(os.path.join(workdir, "config"))
+    path = os.path.join(workdir, "config", "config.ini")
+    with open(path, "w") as f:
+        f.write("[DEFAULT]\nBotToken=0:bench\n")
+    runs = [run(root, workdir, path) for _ in range(opts.runs)]
+    for key in ("import", "init"):
+        print("%-7s median %6.1f ms, max %6.1f ms" % (key, statistics.median(r[key] for r in runs) * 1000,
+                                                    max(r[key] for r in runs) * 1000))
+    print("modules %d, bs4 loaded: %s, aiohttp loaded: %s" % (runs[-1]["modules"], runs[-1]["bs4"],
+                                                            runs[-1]["aiohttp"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Local stand-in for the ps.bahn.de and reiseauskunft.bahn.de endpoints, used by the benchmarks.
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+from upstream import Upstream
+
+SEARCH_PAGE = '<html><body><form><input type="hidden" id="pscExpires" value="{}"/></form></body></html>'
+# ajax-getstop.exe answers with JSONP, 23 characters on each side of the suggestion list
+STATION_ANSWER = 'SLs.sls={{"suggestions":{}}};SLs.showSuggestion();'
+
+
+def make_response(connections=40, offers=None, seed=0, detail=False):
+    # shaped like a full-day psc_service.go answer, detail adds the station, train and offer fields of a real
+    # answer that the bot doesn't use
+    rnd = random.Random(seed)
+    offers = offers or max(1, connections // 2)
+    verbindungen = {}
+    for i in range(connections):
+        dep = rnd.randrange(0, 23 * 60)
+        trains = []
+        for _ in range(rnd.randrange(1, 4)):
+            arr = dep + rnd.randrange(20, 180)
+            trains.append({"dep": {"t": "%02d:%02d" % divmod(dep % 1440, 60)},
+                           "arr": {"t": "%02d:%02d" % divmod(arr % 1440, 60)}})
+            if detail:
+                for stop in ("dep", "arr"):
+                    trains[-1][stop].update({"s": "Bahnhof %d" % rnd.randrange(1000), "p": str(rnd.randrange(1, 25)),
+                                             "d": "%02d.%02d.%02d" % (rnd.randrange(1, 29), rnd.randrange(1, 13), 26),
+                                             "rt": False, "m": ""})
+                trains[-1].update({"tn": "ICE %d" % rnd.randrange(100, 2000), "eg": "ICE", "ezb": True,
+                                   "hinweise": ["Fahrradmitnahme reservierungspflichtig",
+                                                "Bordrestaurant"] * rnd.randrange(1, 3)})
+            dep = arr + rnd.randrange(5, 30)
+        dur = arr - timetomin(trains[0]["dep"]["t"])
+        verbindungen[str(i)] = {"dur": "%d:%02d" % divmod(dur, 60), "trains": trains}
+        if detail:
+            verbindungen[str(i)].update({"sid": str(i), "dt": "19.10.26", "eg": "ICE", "nt": False, "sp": True,
+                                         "hinweise": [], "angebotsinfos": ["Zugbindung", "Umtausch ab 1. Geltungstag"]})
+    angebote = {str(j): {"p": "%d,%02d" % (rnd.randrange(19, 140), rnd.choice((0, 90, 99))), "sids": []}
+                for j in range(offers)}
+    if detail:
+        for offer in angebote.values():
+            offer.update({"name": "Super Sparpreis", "kl": "2", "tt": "Zugbindung", "konditionen": [
+                "Keine Stornierung", "Umtausch gegen Gebühr", "Gilt nur im gebuchten Zug"], "aid": "ABC123"})
+    for i in range(connections):
+        for j in rnd.sample(range(offers), min(offers, rnd.randrange(1, 4))):
+            angebote[str(j)]["sids"].append(str(i))
+    return {"verbindungen": verbindungen, "angebote": angebote}
+
+
+def unlimited(name="bench"):
+    # an upstream guard that never throttles, so the benchmarks measure the client and not the production limits
+    return Upstream(name, rate=10 ** 7, burst=10 ** 7, concurrency=256)
+
+
+def make_station(name):
+    ext_id = "80%05d" % (int(hashlib.md5(name.encode()).hexdigest(), 16) % 100000)
+    return STATION_ANSWER.format(json.dumps([{"value": name, "extId": ext_id, "type": "1"}]))
+
+
+def timetomin(s):
+    (h, m) = s.split(":")
+    return int(h) * 60 + int(m)
+
+
+class FakeBahn(object):
+    def __init__(self, latency=0.05, connections=40, port=0, recorded=None):
+        # recorded is a directory with captured answers (psc_service.json, ajax-getstop.txt) to replay instead of
+        # the generated ones
+        self.latency = latency
+        self.body = json.dumps(make_response(connections)).encode()
+        self.station = None
+        if recorded is not None:
+            if os.path.exists(os.path.join(recorded, "psc_service.json")):
+                with open(os.path.join(recorded, "psc_service.json"), "rb") as f:
+                    self.body = f.read()
+            if os.path.exists(os.path.join(recorded, "ajax-getstop.txt")):
+                with open(os.path.join(recorded, "ajax-getstop.txt"), "rb") as f:
+                    self.station = f.read()
+        self.calls = {"search": 0, "service": 0, "station": 0}
+        # set to answer every request with 503, like an overloaded server
+        self.failing = False
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def reply(self, body, content_type):
+                time.sleep(fake.latency)
+                if fake.failing:
+                    self.send_error(503)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                fake.count("search")
+                self.reply(SEARCH_PAGE.format(int(time.time()) + 3600).encode(), "text/html")
+
+            def do_GET(self):
+                path = urlparse(self.path)
+                if path.path.endswith("psc_service.go"):
+                    fake.count("service")
+                    data = json.loads(parse_qs(path.query)["data"][0])
+                    if not data.get("pscexpires"):
+                        self.reply(json.dumps({"error": {"t": "Sitzung abgelaufen"}}).encode(), "application/json")
+                    else:
+                        self.reply(fake.body, "application/json")
+                elif path.path.endswith("ajax-getstop.exe/dn"):
+                    fake.count("station")
+                    name = parse_qs(path.query).get("S", [""])[0]
+                    self.reply(fake.station or make_station(name).encode(), "text/javascript")
+                else:
+                    self.send_error(404)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def count(self, name):
+        with self.lock:
+            self.calls[name] += 1
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/preissuche/preissuche/" % self.server.server_address[1]
+
+    @property
+    def station_url(self):
+        return "http://127.0.0.1:%d/bin/ajax-getstop.exe/dn" % self.server.server_address[1]
+
+    @property
+    def upstream_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
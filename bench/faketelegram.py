@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Local stand-in for the Telegram Bot API, used by the benchmarks. Point telegram.Bot at it with base_url.
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+class FakeTelegram(object):
+    def __init__(self, latency=0.02, port=0):
+        self.latency = latency
+        # method name -> number of calls
+        self.calls = dict()
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                method = self.path.rsplit("/", 1)[-1]
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                try:
+                    params = json.loads(body) if body else {}
+                except ValueError:
+                    params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+                fake.count(method)
+                time.sleep(fake.latency)
+                result = {"message_id": int(params.get("message_id", 1)), "date": int(time.time()),
+                          "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                          "text": params.get("text", "")}
+                data = json.dumps({"ok": True, "result": result}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def count(self, method):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+    @property
+    def total(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    @property
+    def url(self):
+        # the bot appends its token
+        return "http://127.0.0.1:%d/bot" % self.server.server_address[1]
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
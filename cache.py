@@ -0,0 +1,53 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    # least recently used entries are dropped once size is reached, entries older than ttl seconds are ignored
+    # by get but kept for stale() until they are pushed out
+    def __init__(self, size=256, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def stale(self, key, max_age):
+        # the value even if it is expired, as long as it is younger than max_age seconds
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] - self.ttl + max_age <= time.monotonic():
+                return None
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def __contains__(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and entry[0] > time.monotonic()
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / total if total else 0.0}
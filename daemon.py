@@ -2,163 +2,145 @@
 # -*- coding: utf-8 -*-
 # created by Alwin Ebermann (alwin@alwin.net.au)
 import configparser
-import copy
 import json
-from bs4 import BeautifulSoup
+from bahn import FareClient
+from bahn import cheapest_fare
+from cache import TTLCache
+from health import HealthServer
+from metrics import REGISTRY
+from metrics import span
+from history import PriceRecorder
+from jobs import JobQueue
+from maintenance import Maintenance
+from outbox import Outbox
+from router import CHANGES
+from router import DATE
+from router import DELETE
+from router import DEST
+from router import DURATION
+from router import FETCH
+from router import GROUP
+from router import HOME
+from router import IMPORT
+from router import NOTIFY
+from router import PAGE
+from router import PRICE
+from router import RANGE
+from router import SHOW
+from router import START
+from router import Payload
+from router import Router
+from router import choice
+from router import encode
+from router import page_ref
+from router import parse_date
+from router import parse_page
+from shards import ShardRouter
+from shards import SharedCache
+from shards import SharedRateLimiter
+from shards import SharedStore
+from shards import shard
+from stations import StationFinder
+from upstream import Upstream
+from watcher import Watcher
+from watchlist import is_import
+from watchlist import parse_watchlist
+from watchlist import station_names
+from watchlist import strip_command
 from db import Base
+from db import GROUP_SIZE
 from db import Connection
 from db import User
+from db import create_db_engine
+from db import dest_group
+from db import migrate
+from db import start_group
+from db import station_ids
 from datetime import date
 from datetime import datetime
 from datetime import timedelta
 from re import sub
 from decimal import Decimal, InvalidOperation
 import logging
+import logging.handlers
+import multiprocessing
+import queue
+import secrets
+import signal
+import threading
 import time
-from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import sessionmaker
 import telegram
-import requests
 from telegram import InlineKeyboardButton
 from telegram import InlineKeyboardMarkup
-from telegram.ext import CallbackQueryHandler
-from telegram.ext import CommandHandler
-from telegram.ext import Filters
-from telegram.ext import MessageHandler
-from telegram.ext import Updater
-from telegram.error import ChatMigrated
-from telegram.error import NetworkError
-from telegram.error import TimedOut
-from telegram.error import Unauthorized
+from locale import Error as LocaleError
 from locale import setlocale, LC_ALL
 
-setlocale(LC_ALL, "de_DE")
+# everything below is set up by init(), importing this module has no side effects
 config = configparser.ConfigParser()
-config.read('config/config.ini')
-engine = create_engine('sqlite:///config/bahn.sqlite')
-Base.metadata.bind = engine
-DBSession = sessionmaker(bind=engine)
-updater = Updater(token=config['DEFAULT']['BotToken'])
-dispatcher = updater.dispatcher
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.DEBUG)
+engine = None
+SessionFactory = None
+# one session per thread, i.e. per update while a dispatcher worker handles it. Changes are only written on
+# commit, so no write lock is held while a handler waits for the Bahn servers.
+DBSession = scoped_session(sessionmaker(autoflush=False))
+updater = None
+outbox = None
+stations = None
+prices = None
+fares = None
+watcher = None
+maintenance = None
+runtime = None
+startup_time = None
+# fare cache and rate limits shared by the processes of the multi-process mode
+store = None
+# pages of long result lists, referenced by a short key in the callback data
+results = None
 
 notifications = ["Keine Benachrichtigungen", "Wöchentliche Benachrichtigungen", "Tägliche Benachrichtigungen"]
 
 
-def timetomin(s):
-    (h, m) = s.split(":")
-    return int(h) * 60 + int(m)
-
-
 def reqcons(connection):
-    search = requests.post("https://ps.bahn.de/preissuche/preissuche/psc_angebotssuche.post?lang=de&country=DEU")
-    soup = BeautifulSoup(search.text, "lxml")
-    inp = soup.select("#pscExpires")
-    psc = inp[0].attrs["value"]
-    d = {'lang': 'de', 'country': 'DEU', 'service': 'pscangebotsuche',
-         "data": '{"s":"' + connection.start + '","d":"' + connection.dest + '","dt":"' + connection.date.strftime(
-             "%d.%m.%y") + '","t":"0:00","dur":1440,"pscexpires":"' + psc + '","dir":1,"sv":true,"ohneICE":false,'
-                                                                            '"bic":false,"tct":"0","c":"2",'
-                                                                            '"travellers":[{"typ":"E","bc":"0",'
-                                                                            '"alter":""}]}'}
-    results = requests.get("https://ps.bahn.de/preissuche/preissuche/psc_service.go", params=d, allow_redirects=False)
-    res = results.json()
-    connections = dict()
-    if "error" in res:
-        return res["error"]["t"]
-    for i in range(len(res["verbindungen"])):
-        # get the price now
-        price = 0
-        for j in range(len(res["angebote"])):
-            if str(i) in res["angebote"][str(j)]["sids"]:
-                price = Decimal(res["angebote"][str(j)]["p"].replace(",", "."))
-                break
-        changes = len(res["verbindungen"][str(i)]["trains"]) - 1
-        con = {"changes": len(res["verbindungen"][str(i)]["trains"]) - 1,
-               "duration": timetomin(res["verbindungen"][str(i)]["dur"]), "price": price,
-               "start_time": res["verbindungen"][str(i)]["trains"][0]["dep"]["t"],
-               "arrival_time": res["verbindungen"][str(i)]["trains"][-1]["arr"]["t"], "class": "2"}
-        if con["changes"] <= connection.maxchanges and con["price"] <= connection.maxprice and con[
-            "duration"] <= connection.maxduration:
-            if con["price"] not in connections:
-                connections.update({con["price"]: [con]})
-            else:
-                connections.update({con["price"]: connections[con["price"]] + [con]})
-
-    # the same for 1st class now
-
-    d = {'lang': 'de', 'country': 'DEU', 'service': 'pscangebotsuche',
-         "data": '{"s":"' + connection.start + '","d":"' + connection.dest + '","dt":"' + connection.date.strftime(
-             "%d.%m.%y") + '","t":"0:00","dur":1440,"pscexpires":"' + psc + '","dir":1,"sv":true,"ohneICE":false,'
-                                                                            '"bic":false,"tct":"0","c":"1",'
-                                                                            '"travellers":[{"typ":"E","bc":"0",'
-                                                                            '"alter":""}]}'}
-    results = requests.get("https://ps.bahn.de/preissuche/preissuche/psc_service.go", params=d, allow_redirects=False)
-    res = results.json()
-    if "error" in res:
-        return res["error"]["t"]
-    for i in range(len(res["verbindungen"])):
-        # get the price now
-        price = 0
-        for j in range(len(res["angebote"])):
-            if str(i) in res["angebote"][str(j)]["sids"]:
-                price = Decimal(res["angebote"][str(j)]["p"].replace(",", "."))
-                break
-        changes = len(res["verbindungen"][str(i)]["trains"]) - 1
-        con = {"changes": len(res["verbindungen"][str(i)]["trains"]) - 1,
-               "duration": timetomin(res["verbindungen"][str(i)]["dur"]), "price": price,
-               "start_time": res["verbindungen"][str(i)]["trains"][0]["dep"]["t"],
-               "arrival_time": res["verbindungen"][str(i)]["trains"][-1]["dep"]["t"], "class": "1"}
-        if con["changes"] <= connection.maxchanges and con["price"] <= connection.maxprice and con[
-            "duration"] <= connection.maxduration:
-            if con["price"] not in connections:
-                connections.update({con["price"]: [con]})
-            else:
-                connections.update({con["price"]: connections[con["price"]] + [con]})
-
-    return connections
+    return fares.reqcons(connection, station_ids(start_group(connection)), station_ids(dest_group(connection)))
 
 
 def send_or_edit(bot, update, text, reply_markup=None):
     try:
         message_id = update.callback_query.message.message_id
         chat_id = update.callback_query.message.chat.id
-        try:
-            bot.editMessageText(text=text, chat_id=chat_id, message_id=message_id, reply_markup=reply_markup,
-                                parse_mode=telegram.ParseMode.MARKDOWN, disable_web_page_preview=True)
-        except Unauthorized:
-            session = DBSession()
-            user = session.query(User).filter(User.id == chat_id).first()
-            session.delete(user)
-            session.commit()
-            session.close()
-        except TimedOut:
-            time.sleep(20)
-            return send_or_edit(bot, update, text, reply_markup)
-        except ChatMigrated as e:
-            session = DBSession()
-            user = session.query(User).filter(User.id == chat_id).first()
-            user.id = e.new_chat_id
-            session.commit()
-            session.close()
-            return True
-        except NetworkError:
-            return False
+        outbox.edit(chat_id, message_id, text, reply_markup)
     except AttributeError:
-        bot.sendMessage(text=text, chat_id=update.message.chat.id, reply_markup=reply_markup,
-                        parse_mode=telegram.ParseMode.MARKDOWN, disable_web_page_preview=True)
+        outbox.send(update.message.chat.id, text, reply_markup)
+
+
+def RemoveUser(chat_id):
+    # the connections go as well, nobody would receive their notifications
+    session = SessionFactory()
+    user = session.query(User).filter(User.id == chat_id).first()
+    if user:
+        session.query(Connection).filter(Connection.user_id == chat_id).delete(synchronize_session=False)
+        session.delete(user)
+        session.commit()
+    session.close()
+
+
+def MigrateUser(chat_id, new_chat_id):
+    session = SessionFactory()
+    user = session.query(User).filter(User.id == chat_id).first()
+    if user:
+        user.id = new_chat_id
+        session.commit()
+    session.close()
 
 
 def findstation(name):
-    payload = {"REQ0JourneyStopsS0A": "1", "REQ0JourneyStopsB": 1, "S": name}
-    r = requests.get("https://reiseauskunft.bahn.de/bin/ajax-getstop.exe/dn", params=payload)
-    try:
-        return json.loads(r.text[23:-23])[0]
-    except IndexError:
-        return False
+    return stations.find(name, DBSession())
 
 
 def CheckUser(bot, update):
+    # returns the user attached to the session of this update and its selection before this update
     session = DBSession()
     try:
         chat = update.message.chat
@@ -171,23 +153,18 @@ def CheckUser(bot, update):
         # user is unknown
         new_user = User(id=chat.id, first_name=chat.first_name, last_name=chat.last_name, username=chat.username,
                         title=chat.title, counter=0, current_selection="0")
-        new_usr = copy.deepcopy(new_user)
         session.add(new_user)
-        session.commit()
         message = "Mit diesem Bot kannst du die Preisentwicklung von DB Sparpreisen überwachen. Richte gleich eine Verbindung ein."
-        bot.sendMessage(chat_id=chat.id, text=message, reply_markup=telegram.ReplyKeyboardRemove())
-        session.close()
-        return new_usr
+        outbox.send(chat.id, message, telegram.ReplyKeyboardRemove(), parse_mode=None)
+        return new_user, "0"
     else:
         entry.counter += 1
-        ent = copy.deepcopy(entry)
+        previous = entry.current_selection
         entry.current_selection = current_selection if not current_selection == "message" else "0"
-        session.commit()
-        session.close()
-        return ent
+        return entry, previous
 
 
-def ShowHome(bot, update, usr):
+def ShowHome(bot, update, usr, payload=None):
     s = DBSession()
     conns = s.query(Connection).filter(Connection.user_id == usr.id, Connection.date >= date.today()).all()
     if len(conns) > 0:
@@ -195,97 +172,135 @@ def ShowHome(bot, update, usr):
         button_list = []
         for conn in conns:
             button_list.append([InlineKeyboardButton("🚄 " + conn.start_name + " - " + conn.dest_name,
-                                                     callback_data="1$" + str(conn.id))])
-        button_list.append([InlineKeyboardButton("➕ Neuen Verbindung erstellen", callback_data="2$-1")])
+                                                     callback_data=encode(SHOW, conn.id))])
+        button_list.append([InlineKeyboardButton("➕ Neuen Verbindung erstellen", callback_data=encode(START, -1))])
+        button_list.append([InlineKeyboardButton("📋 Mehrere importieren", callback_data=encode(IMPORT, -1))])
         send_or_edit(bot, update, message, InlineKeyboardMarkup(button_list))
     else:
         message = "Noch keine Benachrichtigungen erstellt. Leg gleich los:"
-        button_list = [[InlineKeyboardButton("➕ Neuen Benachrichtigung erstellen", callback_data="2$-1")]]
+        button_list = [[InlineKeyboardButton("➕ Neuen Benachrichtigung erstellen", callback_data=encode(START, -1))],
+                       [InlineKeyboardButton("📋 Mehrere importieren", callback_data=encode(IMPORT, -1))]]
         send_or_edit(bot, update, message, InlineKeyboardMarkup(button_list))
-    s.close()
 
 
-def SetStart(bot, update, usr, args):
+def SetStart(bot, update, usr, payload):
     if update.callback_query is not None:
-        if len(args) == 2:  # first indication that user wants to change start
+        if payload.extra is None:  # first indication that user wants to change start
             send_or_edit(bot, update, "Bitte gib einen Startbahnhof ein:")
     else:  # now process start and change
         station = findstation(update.message.text)
         if not station:
-            s = DBSession()
-            entry = s.query(User).filter(User.id == usr.id).first()
-            entry.current_selection = "2$" + args[1]
-            s.commit()
-            s.close()
+            usr.current_selection = encode(START, payload.target)
             send_or_edit(bot, update, "Das ist kein Bahnhof. Bitte nochmal versuchen.")
             return False
-        if args[1] == "-1":  # create new entry
+        if payload.target == -1:  # create new entry
             s = DBSession()
             conn = Connection(start=station["extId"], start_name=station["value"], user_id=usr.id, date=date.today(),
                               dest=station["extId"], dest_name=station["value"])
             s.add(conn)
-            entry = s.query(User).filter(User.id == usr.id).first()
-            entry.current_selection = "3$" + str(conn.id)
-            s.commit()
-            s.close()
+            s.flush()  # assigns conn.id
+            usr.current_selection = encode(DEST, conn.id)
             send_or_edit(bot, update, "Wo soll es von " + station["value"] + " hingehen?")
         else:  # update existing
             s = DBSession()
-            conn = s.query(Connection).filter(Connection.user_id == usr.id, Connection.id == args[1]).first()
+            conn = s.query(Connection).filter(Connection.user_id == usr.id, Connection.id == payload.target).first()
             if not conn:
-                button_list = [[InlineKeyboardButton("🏠 Home", callback_data="0")]]
+                button_list = [[InlineKeyboardButton("🏠 Home", callback_data=encode(HOME))]]
                 send_or_edit(bot, update,
                              "Diese Verbindung kann nicht gefunden werden. Vielleicht liegt sie in der Vergangenheit.",
                              InlineKeyboardMarkup(button_list))
             else:
                 conn.start = station["extId"]
                 conn.start_name = station["value"]
-                s.commit()
-                button_list = [[InlineKeyboardButton("🚄 Verbindung", callback_data="1$" + str(conn.id)),
-                                InlineKeyboardButton("🏠 Home", callback_data="0"),
-                                InlineKeyboardButton("⛱️ Ziel ändern", callback_data="3$" + str(conn.id))]]
+                conn.notified_hash = None
+                button_list = [[InlineKeyboardButton("🚄 Verbindung", callback_data=encode(SHOW, conn.id)),
+                                InlineKeyboardButton("🏠 Home", callback_data=encode(HOME)),
+                                InlineKeyboardButton("⛱️ Ziel ändern", callback_data=encode(DEST, conn.id))]]
                 send_or_edit(bot, update,
                              "Start erfolgreich geändert.",
                              InlineKeyboardMarkup(button_list))
-            s.close()
 
 
-def SetDest(bot, update, usr, args):
+IMPORT_HELP = ("Schick mir die Verbindungen, eine pro Zeile, z.B.\n"
+               "München Hbf - Berlin Hbf 12.11.2026 <40€ <5h <1x\n"
+               "Preis, Fahrzeit (<5h oder <90min) und Umstiege sind optional. Über mehrere Bahnhöfe "
+               "(A - B - C) wird je Abschnitt eine Verbindung angelegt, mit A|B werden beide Bahnhöfe abgefragt.")
+
+
+def import_group(names, found):
+    # the further stations of a group as stored in Connection.start_group/dest_group, None without any
+    stations = list(dict.fromkeys((found[name]["extId"], found[name]["value"]) for name in names[1:]
+                                  if found[name]["extId"] != found[names[0]]["extId"]))
+    return json.dumps([list(station) for station in stations]) if stations else None
+
+
+def ImportWatches(bot, update, usr, payload):
+    # a whole watch list in one message: everything is checked first, then all connections are added together
+    text = strip_command(update.message.text) if update.callback_query is None else ""
+    if not text:
+        usr.current_selection = encode(IMPORT, -1)
+        send_or_edit(bot, update, IMPORT_HELP)
+        return
+    watches, errors = parse_watchlist(text, date.today())
+    if not errors:
+        found = stations.find_all(station_names(watches))
+        errors = list(dict.fromkeys((watch.line, "Bahnhof " + name + " nicht gefunden") for watch in watches
+                                    for name in watch.start + watch.dest if not found[name]))
+    if errors:
+        # the lines are the user's own text, so no Markdown
+        usr.current_selection = encode(IMPORT, -1)
+        outbox.send(update.message.chat.id, "Nichts importiert, bitte korrigiere die Liste:\n" + "\n".join(
+            (line + ": " if line else "") + reason for line, reason in errors), parse_mode=None)
+        return False
+    s = DBSession()
+    conns = []
+    for watch in watches:
+        # limits that are not given keep the defaults of the columns
+        limits = {key: value for key, value in (("maxprice", watch.maxprice), ("maxduration", watch.maxduration),
+                                                ("maxchanges", watch.maxchanges)) if value is not None}
+        start, dest = found[watch.start[0]], found[watch.dest[0]]
+        conns.append(Connection(user_id=usr.id, date=watch.date, start=start["extId"], start_name=start["value"],
+                                dest=dest["extId"], dest_name=dest["value"],
+                                start_group=import_group(watch.start, found),
+                                dest_group=import_group(watch.dest, found), **limits))
+    s.add_all(conns)
+    button_list = [[InlineKeyboardButton("🏠 Home", callback_data=encode(HOME))]]
+    outbox.send(update.message.chat.id, str(len(conns)) + " Verbindungen angelegt:\n" + "\n".join(
+        conn.start_name + " - " + conn.dest_name + " am " + conn.date.strftime("%d.%m.%Y") for conn in conns),
+        InlineKeyboardMarkup(button_list), parse_mode=None)
+
+
+def SetDest(bot, update, usr, payload):
     if update.callback_query is not None:
-        if len(args) == 2:  # first indication that user wants to change start
+        if payload.extra is None:  # first indication that user wants to change start
             send_or_edit(bot, update, "Bitte gib einen Zielbahnhof ein:")
     else:  # now process start and change
         station = findstation(update.message.text)
         if not station:
-            s = DBSession()
-            entry = s.query(User).filter(User.id == usr.id).first()
-            entry.current_selection = "2$" + args[1]
-            s.commit()
-            s.close()
+            usr.current_selection = encode(DEST, payload.target)
             send_or_edit(bot, update, "Das ist kein Bahnhof. Bitte nochmal versuchen.")
             return False
 
         s = DBSession()
-        conn = s.query(Connection).filter(Connection.user_id == usr.id, Connection.id == args[1]).first()
+        conn = s.query(Connection).filter(Connection.user_id == usr.id, Connection.id == payload.target).first()
         if not conn:
-            button_list = [[InlineKeyboardButton("🏠 Home", callback_data="0")]]
+            button_list = [[InlineKeyboardButton("🏠 Home", callback_data=encode(HOME))]]
             send_or_edit(bot, update,
                          "Diese Verbindung kann nicht gefunden werden. Vielleicht liegt sie in der Vergangenheit.",
                          InlineKeyboardMarkup(button_list))
         else:
             conn.dest = station["extId"]
             conn.dest_name = station["value"]
-            s.commit()
-            button_list = [[InlineKeyboardButton("🚄 Verbindung", callback_data="1$" + str(conn.id)),
-                            InlineKeyboardButton("🏠 Home", callback_data="0"),
-                            InlineKeyboardButton("🗓 Datum ändern", callback_data="4$" + str(conn.id))]]
+            conn.notified_hash = None
+            button_list = [[InlineKeyboardButton("🚄 Verbindung", callback_data=encode(SHOW, conn.id)),
+                            InlineKeyboardButton("🏠 Home", callback_data=encode(HOME)),
+                            InlineKeyboardButton("🗓 Datum ändern", callback_data=encode(DATE, conn.id))]]
             send_or_edit(bot, update, "Ziel erfolgreich geändert.", InlineKeyboardMarkup(button_list))
-        s.close()
 
 
-def SetDate(bot, update, usr, args):
+def SetDate(bot, update, usr, payload):
     if update.callback_query is not None:
-        if len(args) == 2:  # first indication that user wants to change start
+        if payload.extra is None:  # first indication that user wants to change start
             send_or_edit(bot, update, "Bitte gib ein neues Datum im Format TT.MM.JJJJ ein:")
     else:  # now process start and change
         try:
@@ -295,32 +310,27 @@ def SetDate(bot, update, usr, args):
         except ValueError:
             send_or_edit(bot, update,
                          "Das ist kein gültiges Datum oder liegt schon in der Vergangenheit. Das Format muss TT.MM.JJJJ sein.")
-            s = DBSession()
-            entry = s.query(User).filter(User.id == usr.id).first()
-            entry.current_selection = "4$" + args[1]
-            s.commit()
-            s.close()
+            usr.current_selection = encode(DATE, payload.target)
             return False
         s = DBSession()
-        conn = s.query(Connection).filter(Connection.user_id == usr.id, Connection.id == args[1]).first()
+        conn = s.query(Connection).filter(Connection.user_id == usr.id, Connection.id == payload.target).first()
         if not conn:
-            button_list = [[InlineKeyboardButton("🏠 Home", callback_data="0")]]
+            button_list = [[InlineKeyboardButton("🏠 Home", callback_data=encode(HOME))]]
             send_or_edit(bot, update,
                          "Diese Verbindung kann nicht gefunden werden. Vielleicht liegt sie in der Vergangenheit.",
                          InlineKeyboardMarkup(button_list))
         else:
             conn.date = dat
-            s.commit()
-            button_list = [[InlineKeyboardButton("🚄 Verbindung", callback_data="1$" + str(conn.id)),
-                            InlineKeyboardButton("🏠 Home", callback_data="0"),
-                            InlineKeyboardButton("💶 Max. Preis ändern", callback_data="5$" + str(conn.id))]]
+            conn.notified_hash = None
+            button_list = [[InlineKeyboardButton("🚄 Verbindung", callback_data=encode(SHOW, conn.id)),
+                            InlineKeyboardButton("🏠 Home", callback_data=encode(HOME)),
+                            InlineKeyboardButton("💶 Max. Preis ändern", callback_data=encode(PRICE, conn.id))]]
             send_or_edit(bot, update, "Datum erfolgreich geändert.", InlineKeyboardMarkup(button_list))
-        s.close()
 
 
-def SetPrice(bot, update, usr, args):
+def SetPrice(bot, update, usr, payload):
     if update.callback_query is not None:
-        if len(args) == 2:  # first indication that user wants to change start
+        if payload.extra is None:  # first indication that user wants to change start
             send_or_edit(bot, update, "Bitte gib einen neuen Maximalpreis an.")
     else:  # now process start and change
         price = sub(r'[^0-9.,]+', "", update.message.text)
@@ -330,33 +340,27 @@ def SetPrice(bot, update, usr, args):
         except InvalidOperation:
             send_or_edit(bot, update,
                          "Diese Eingabe konnte nicht in eine Zahl umgewandelt werden.")
-            s = DBSession()
-            entry = s.query(User).filter(User.id == usr.id).first()
-            entry.current_selection = "5$" + args[1]
-            s.commit()
-            s.close()
+            usr.current_selection = encode(PRICE, payload.target)
             return False
 
         s = DBSession()
-        conn = s.query(Connection).filter(Connection.user_id == usr.id, Connection.id == args[1]).first()
+        conn = s.query(Connection).filter(Connection.user_id == usr.id, Connection.id == payload.target).first()
         if not conn:
-            button_list = [[InlineKeyboardButton("🏠 Home", callback_data="0")]]
+            button_list = [[InlineKeyboardButton("🏠 Home", callback_data=encode(HOME))]]
             send_or_edit(bot, update,
                          "Diese Verbindung kann nicht gefunden werden. Vielleicht liegt sie in der Vergangenheit.",
                          InlineKeyboardMarkup(button_list))
         else:
             conn.maxprice = price
-            s.commit()
-            button_list = [[InlineKeyboardButton("🚄 Verbindung", callback_data="1$" + str(conn.id)),
-                            InlineKeyboardButton("🏠 Home", callback_data="0"),
-                            InlineKeyboardButton("🕐 Max. Fahrzeit ändern", callback_data="6$" + str(conn.id))]]
+            button_list = [[InlineKeyboardButton("🚄 Verbindung", callback_data=encode(SHOW, conn.id)),
+                            InlineKeyboardButton("🏠 Home", callback_data=encode(HOME)),
+                            InlineKeyboardButton("🕐 Max. Fahrzeit ändern", callback_data=encode(DURATION, conn.id))]]
             send_or_edit(bot, update, "Maximalpreis erfolgreich geändert.", InlineKeyboardMarkup(button_list))
-        s.close()
 
 
-def SetDuration(bot, update, usr, args):
+def SetDuration(bot, update, usr, payload):
     if update.callback_query is not None:
-        if len(args) == 2:  # first indication that user wants to change start
+        if payload.extra is None:  # first indication that user wants to change start
             send_or_edit(bot, update, "Bitte gib eine neue Maximaldauer in Minuten an.")
     else:  # now process start and change
         duration = sub(r'\D+', "", update.message.text)
@@ -367,33 +371,27 @@ def SetDuration(bot, update, usr, args):
         except ValueError:
             send_or_edit(bot, update,
                          "Diese Eingabe konnte nicht in eine Zahl umgewandelt werden.")
-            s = DBSession()
-            entry = s.query(User).filter(User.id == usr.id).first()
-            entry.current_selection = "6$" + args[1]
-            s.commit()
-            s.close()
+            usr.current_selection = encode(DURATION, payload.target)
             return False
 
         s = DBSession()
-        conn = s.query(Connection).filter(Connection.user_id == usr.id, Connection.id == args[1]).first()
+        conn = s.query(Connection).filter(Connection.user_id == usr.id, Connection.id == payload.target).first()
         if not conn:
-            button_list = [[InlineKeyboardButton("🏠 Home", callback_data="0")]]
+            button_list = [[InlineKeyboardButton("🏠 Home", callback_data=encode(HOME))]]
             send_or_edit(bot, update,
                          "Diese Verbindung kann nicht gefunden werden. Vielleicht liegt sie in der Vergangenheit.",
                          InlineKeyboardMarkup(button_list))
         else:
             conn.maxduration = duration
-            s.commit()
-            button_list = [[InlineKeyboardButton("🚄 Verbindung", callback_data="1$" + str(conn.id)),
-                            InlineKeyboardButton("🏠 Home", callback_data="0"),
-                            InlineKeyboardButton("🚏 Max. Umstiege ändern", callback_data="7$" + str(conn.id))]]
+            button_list = [[InlineKeyboardButton("🚄 Verbindung", callback_data=encode(SHOW, conn.id)),
+                            InlineKeyboardButton("🏠 Home", callback_data=encode(HOME)),
+                            InlineKeyboardButton("🚏 Max. Umstiege ändern", callback_data=encode(CHANGES, conn.id))]]
             send_or_edit(bot, update, "Maximaldauer erfolgreich geändert.", InlineKeyboardMarkup(button_list))
-        s.close()
 
 
-def SetChanges(bot, update, usr, args):
+def SetChanges(bot, update, usr, payload):
     if update.callback_query is not None:
-        if len(args) == 2:  # first indication that user wants to change start
+        if payload.extra is None:  # first indication that user wants to change start
             send_or_edit(bot, update, "Bitte gib eine neue Maximalanzahl an Umstiegen an.")
     else:  # now process start and change
         changes = sub(r'\D+', "", update.message.text)
@@ -403,59 +401,54 @@ def SetChanges(bot, update, usr, args):
                 raise ValueError
         except ValueError:
             send_or_edit(bot, update, "Diese Eingabe konnte nicht in eine Zahl umgewandelt werden.")
-            s = DBSession()
-            entry = s.query(User).filter(User.id == usr.id).first()
-            entry.current_selection = "7$" + args[1]
-            s.commit()
-            s.close()
+            usr.current_selection = encode(CHANGES, payload.target)
             return False
 
         s = DBSession()
-        conn = s.query(Connection).filter(Connection.user_id == usr.id, Connection.id == args[1]).first()
+        conn = s.query(Connection).filter(Connection.user_id == usr.id, Connection.id == payload.target).first()
         if not conn:
-            button_list = [[InlineKeyboardButton("🏠 Home", callback_data="0")]]
+            button_list = [[InlineKeyboardButton("🏠 Home", callback_data=encode(HOME))]]
             send_or_edit(bot, update,
                          "Diese Verbindung kann nicht gefunden werden. Vielleicht liegt sie in der Vergangenheit.",
                          InlineKeyboardMarkup(button_list))
         else:
             conn.maxchanges = changes
-            s.commit()
-            button_list = [[InlineKeyboardButton("🚄 Verbindung", callback_data="1$" + str(conn.id)),
-                            InlineKeyboardButton("🏠 Home", callback_data="0"),
-                            InlineKeyboardButton("📯 Ben. ändern", callback_data="8$" + str(conn.id))]]
+            button_list = [[InlineKeyboardButton("🚄 Verbindung", callback_data=encode(SHOW, conn.id)),
+                            InlineKeyboardButton("🏠 Home", callback_data=encode(HOME)),
+                            InlineKeyboardButton("📯 Ben. ändern", callback_data=encode(NOTIFY, conn.id))]]
             send_or_edit(bot, update, "Maximalumstiege erfolgreich geändert.", InlineKeyboardMarkup(button_list))
-        s.close()
 
 
-def SetNotifications(bot, update, usr, args):
-    if len(args) == 2:  # list options
-        button_list = [[InlineKeyboardButton("Keine Benachrichtigung", callback_data="8$" + args[1] + "$0")],
-                       [InlineKeyboardButton("Wöchentliche Benachrichtigung", callback_data="8$" + args[1] + "$1")],
-                       [InlineKeyboardButton("Tägliche Benachrichtigung", callback_data="8$" + args[1] + "$2")]]
+def SetNotifications(bot, update, usr, payload):
+    if payload.extra is None:  # list options
+        button_list = [[InlineKeyboardButton("Keine Benachrichtigung",
+                                             callback_data=encode(NOTIFY, payload.target, 0))],
+                       [InlineKeyboardButton("Wöchentliche Benachrichtigung",
+                                             callback_data=encode(NOTIFY, payload.target, 1))],
+                       [InlineKeyboardButton("Tägliche Benachrichtigung",
+                                             callback_data=encode(NOTIFY, payload.target, 2))]]
         send_or_edit(bot, update, "Wie oft möchtest du über diese Verbindung benachrichtigt werden?",
                      InlineKeyboardMarkup(button_list))
-    elif len(args) == 3 and int(args[2]) in [0, 1, 2]:
+    else:
         s = DBSession()
-        conn = s.query(Connection).filter(Connection.user_id == usr.id, Connection.id == int(args[1])).first()
+        conn = s.query(Connection).filter(Connection.user_id == usr.id, Connection.id == payload.target).first()
         if not conn:
-            button_list = [[InlineKeyboardButton("🏠 Home", callback_data="0")]]
+            button_list = [[InlineKeyboardButton("🏠 Home", callback_data=encode(HOME))]]
             send_or_edit(bot, update,
                          "Diese Verbindung kann nicht gefunden werden. Vielleicht liegt sie in der Vergangenheit.",
                          InlineKeyboardMarkup(button_list))
         else:
-            conn.notifications = int(args[2])
-            s.commit()
-            button_list = [[InlineKeyboardButton("🚄 Verbindung", callback_data="1$" + str(conn.id)),
-                            InlineKeyboardButton("🏠 Home", callback_data="0")]]
+            conn.notifications = payload.extra
+            button_list = [[InlineKeyboardButton("🚄 Verbindung", callback_data=encode(SHOW, conn.id)),
+                            InlineKeyboardButton("🏠 Home", callback_data=encode(HOME))]]
             send_or_edit(bot, update, "Benachrichtigungen erfolgreich geändert.", InlineKeyboardMarkup(button_list))
-        s.close()
 
 
-def ShowConnection(bot, update, usr, args):
+def ShowConnection(bot, update, usr, payload):
     s = DBSession()
-    conn = s.query(Connection).filter(Connection.user_id == usr.id, Connection.id == args[1]).first()
+    conn = s.query(Connection).filter(Connection.user_id == usr.id, Connection.id == payload.target).first()
     if not conn:
-        button_list = [[InlineKeyboardButton("🏠 Home", callback_data="0")]]
+        button_list = [[InlineKeyboardButton("🏠 Home", callback_data=encode(HOME))]]
         send_or_edit(bot, update,
                      "Diese Verbindung kann nicht gefunden werden. Vielleicht liegt sie in der Vergangenheit.",
                      InlineKeyboardMarkup(button_list))
@@ -465,30 +458,88 @@ def ShowConnection(bot, update, usr, args):
                                                                                                      ",") + "€\n*Maximaldauer: *" + str(
             conn.maxduration // 60) + ":" + format(conn.maxduration % 60, '02d') + "h\n*Maximale Umstiege:* " + str(
             conn.maxchanges) + "\n*Benachrichtigungen:* " + notifications[conn.notifications]
-        button_list = [[InlineKeyboardButton("🚉 Start ändern", callback_data="2$" + str(conn.id)),
-                        InlineKeyboardButton("⛱️ Ziel ändern", callback_data="3$" + str(conn.id))],
-                       [InlineKeyboardButton("🗓 Datum ändern", callback_data="4$" + str(conn.id)),
-                        InlineKeyboardButton("💶 Maximalpreis ändern", callback_data="5$" + str(conn.id))],
-                       [InlineKeyboardButton("🕐 Maximaldauer ändern", callback_data="6$" + str(conn.id)),
-                        InlineKeyboardButton("🚏 Maximale Umstiege ändern", callback_data="7$" + str(conn.id))],
-                       [InlineKeyboardButton("📯 Benachrichtigungen ändern", callback_data="8$" + str(conn.id)),
-                        InlineKeyboardButton("💣 Löschen", callback_data="10$" + str(conn.id))],
-                       [InlineKeyboardButton("🏠 Home", callback_data="0"),
-                        InlineKeyboardButton("🎇 Jetzt abrufen", callback_data="9$" + str(conn.id))]]
+        starts, dests = start_group(conn), dest_group(conn)
+        if len(starts) > 1:
+            message += "\n*Auch ab: *" + ", ".join(name for ext_id, name in starts[1:])
+        if len(dests) > 1:
+            message += "\n*Auch nach: *" + ", ".join(name for ext_id, name in dests[1:])
+        button_list = [[InlineKeyboardButton("🚉 Start ändern", callback_data=encode(START, conn.id)),
+                        InlineKeyboardButton("⛱️ Ziel ändern", callback_data=encode(DEST, conn.id))],
+                       [InlineKeyboardButton("➕ Weiterer Start", callback_data=encode(GROUP, conn.id, 0)),
+                        InlineKeyboardButton("➕ Weiteres Ziel", callback_data=encode(GROUP, conn.id, 1))],
+                       [InlineKeyboardButton("🗓 Datum ändern", callback_data=encode(DATE, conn.id)),
+                        InlineKeyboardButton("💶 Maximalpreis ändern", callback_data=encode(PRICE, conn.id))],
+                       [InlineKeyboardButton("🕐 Maximaldauer ändern", callback_data=encode(DURATION, conn.id)),
+                        InlineKeyboardButton("🚏 Maximale Umstiege ändern", callback_data=encode(CHANGES, conn.id))],
+                       [InlineKeyboardButton("📯 Benachrichtigungen ändern", callback_data=encode(NOTIFY, conn.id)),
+                        InlineKeyboardButton("💣 Löschen", callback_data=encode(DELETE, conn.id))],
+                       [InlineKeyboardButton("🏠 Home", callback_data=encode(HOME)),
+                        InlineKeyboardButton("🎇 Jetzt abrufen", callback_data=encode(FETCH, conn.id))]]
+        if len(starts) > 1 or len(dests) > 1:
+            button_list.insert(2, [InlineKeyboardButton("✖️ Weitere Bahnhöfe entfernen",
+                                                        callback_data=encode(GROUP, conn.id, 2))])
         send_or_edit(bot, update, message, InlineKeyboardMarkup(button_list))
-    s.close()
 
 
-def DeleteConnection(bot, update, usr, args):
-    if len(args) == 2:
-        button_list = [[InlineKeyboardButton("💣 Wirklich löschen", callback_data="10$" + args[1] + "$1")],
-                       [InlineKeyboardButton("🚄 Zurück", callback_data="1$" + args[1])]]
+def SetGroup(bot, update, usr, payload):
+    # extra 0 adds a start and 1 a destination to the station group of the connection, 2 removes both groups
+    if update.callback_query is not None and payload.extra != 2:
+        send_or_edit(bot, update, "Bitte gib einen weiteren " + ("Start" if payload.extra == 0 else "Ziel") +
+                     "bahnhof ein, der mit abgefragt werden soll:")
+        return
+    if update.callback_query is None and payload.extra == 2:
+        # only the button removes the groups, not any text typed afterwards
+        ShowConnection(bot, update, usr, Payload(SHOW, payload.target, None))
+        return
+    s = DBSession()
+    conn = s.query(Connection).filter(Connection.user_id == usr.id, Connection.id == payload.target).first()
+    if not conn:
+        button_list = [[InlineKeyboardButton("🏠 Home", callback_data=encode(HOME))]]
+        send_or_edit(bot, update,
+                     "Diese Verbindung kann nicht gefunden werden. Vielleicht liegt sie in der Vergangenheit.",
+                     InlineKeyboardMarkup(button_list))
+        return
+    button_list = [[InlineKeyboardButton("🚄 Verbindung", callback_data=encode(SHOW, conn.id)),
+                    InlineKeyboardButton("🏠 Home", callback_data=encode(HOME))]]
+    if payload.extra == 2:
+        conn.start_group = None
+        conn.dest_group = None
+        conn.notified_hash = None
+        send_or_edit(bot, update, "Weitere Bahnhöfe entfernt.", InlineKeyboardMarkup(button_list))
+        return
+    station = findstation(update.message.text)
+    if not station:
+        usr.current_selection = encode(GROUP, payload.target, payload.extra)
+        send_or_edit(bot, update, "Das ist kein Bahnhof. Bitte nochmal versuchen.")
+        return False
+    group = start_group(conn) if payload.extra == 0 else dest_group(conn)
+    if station["extId"] in station_ids(group):
+        send_or_edit(bot, update, station["value"] + " wird schon abgefragt.", InlineKeyboardMarkup(button_list))
+        return
+    if len(group) >= GROUP_SIZE:
+        send_or_edit(bot, update, "Es können höchstens " + str(GROUP_SIZE) + " Bahnhöfe zusammen abgefragt werden.",
+                     InlineKeyboardMarkup(button_list))
+        return
+    extra = json.dumps([list(entry) for entry in group[1:]] + [[station["extId"], station["value"]]])
+    if payload.extra == 0:
+        conn.start_group = extra
+    else:
+        conn.dest_group = extra
+    conn.notified_hash = None
+    send_or_edit(bot, update, station["value"] + " wird jetzt mit abgefragt.", InlineKeyboardMarkup(button_list))
+
+
+def DeleteConnection(bot, update, usr, payload):
+    if payload.extra is None:
+        button_list = [[InlineKeyboardButton("💣 Wirklich löschen",
+                                             callback_data=encode(DELETE, payload.target, 1))],
+                       [InlineKeyboardButton("🚄 Zurück", callback_data=encode(SHOW, payload.target))]]
         send_or_edit(bot, update, "Willst du wirklich diese Verbindung löschen?", InlineKeyboardMarkup(button_list))
-    elif len(args) == 3 and args[2] == "1":
+    elif payload.extra == 1:
         s = DBSession()
-        conn = s.query(Connection).filter(Connection.user_id == usr.id, Connection.id == args[1]).first()
+        conn = s.query(Connection).filter(Connection.user_id == usr.id, Connection.id == payload.target).first()
         if not conn:
-            button_list = [[InlineKeyboardButton("🏠 Home", callback_data="0")]]
+            button_list = [[InlineKeyboardButton("🏠 Home", callback_data=encode(HOME))]]
             send_or_edit(bot, update,
                          "Diese Verbindung kann nicht gefunden werden. Vielleicht liegt sie in der Vergangenheit.",
                          InlineKeyboardMarkup(button_list))
@@ -496,101 +547,548 @@ def DeleteConnection(bot, update, usr, args):
             message = "Die Verbindung von " + conn.start_name + " nach " + conn.dest_name + " am " + conn.date.strftime(
                 "%d.%m.%Y") + " wurde erfolgreich gelöscht."
             s.delete(conn)
-            s.commit()
-            button_list = [[InlineKeyboardButton("🏠 Home", callback_data="0")]]
+            button_list = [[InlineKeyboardButton("🏠 Home", callback_data=encode(HOME))]]
             send_or_edit(bot, update, message, InlineKeyboardMarkup(button_list))
-        s.close()
 
 
-def RequestConnections(bot, update, usr, args):
-    con = args[1] if len(args) > 1 else 0
+# Telegram refuses messages longer than 4096 characters, the rest is room for the page footer
+PAGE_SIZE = 3800
+
+
+def format_fare(ent, names):
+    line = "%s Uhr - %s Uhr (%dh%02dmin), %dx umsteigen, %s. Klasse" % (
+        ent.start_time, ent.arrival_time, ent.duration // 60, ent.duration % 60, ent.changes, ent.klass)
+    if hasattr(ent, "start"):
+        # found by a station group search
+        line += " (" + names.get(ent.start, ent.start) + " → " + names.get(ent.dest, ent.dest) + ")"
+    return line
+
+
+def group_label(group):
+    # "Berlin Hbf (+2)" for a station group
+    return group[0][1] + (" (+" + str(len(group) - 1) + ")" if len(group) > 1 else "")
+
+
+def paginate_connections(conn, entries, size=PAGE_SIZE):
+    # lines are collected and joined once per page, a price group split across pages repeats its heading
+    starts, dests = start_group(conn), dest_group(conn)
+    header = "Verbindungen von " + group_label(starts) + " nach " + group_label(dests) + " am " + conn.date.strftime(
+        "%a, %d.%m.%Y") + ":"
+    if type(entries) is str:
+        return [header + "\n" + entries]
+    if not entries:
+        return ["Keine Verbindungen unter diesen Kriterien gefunden."]
+    names = dict(starts + dests)
+    pages = []
+    lines = [header]
+    length = len(header)
+    for key, entry in sorted(entries.items()):
+        title = "*" + str(key) + "€*:"
+        for i, ent in enumerate(entry):
+            block = [title, format_fare(ent, names)] if i == 0 else [format_fare(ent, names)]
+            needed = sum(len(line) + 1 for line in block)
+            if length + needed > size and len(lines) > 1:
+                pages.append("\n".join(lines))
+                lines = [header] if i == 0 else [header, title]
+                length = sum(len(line) + 1 for line in lines) - 1
+            lines.extend(block)
+            length += needed
+    pages.append("\n".join(lines))
+    return pages
+
+
+def format_connections(conn, entries):
+    # single message for the watcher, the full list is behind its "Jetzt abrufen" button
+    pages = paginate_connections(conn, entries)
+    if len(pages) > 1:
+        return pages[0] + "\n\n_… und weitere Verbindungen_"
+    return pages[0]
+
+
+def result_buttons(conn_id, day, key=None, page=0, count=1):
+    button_list = []
+    if count > 1:
+        button_list.append([InlineKeyboardButton("◀️ Seite " + str(page),
+                                                 callback_data=encode(PAGE, conn_id, page_ref(key, page - 1)))
+                            if page > 0 else None,
+                            InlineKeyboardButton("Seite " + str(page + 2) + " ▶️",
+                                                 callback_data=encode(PAGE, conn_id, page_ref(key, page + 1)))
+                            if page + 1 < count else None])
+    button_list += [[InlineKeyboardButton("🚄 Verbindung", callback_data=encode(SHOW, conn_id)),
+                     InlineKeyboardButton("🏠 Home", callback_data=encode(HOME))],
+                    [InlineKeyboardButton("◀️ vorheriger Tag",
+                                          callback_data=encode(FETCH, conn_id, day + timedelta(-1))),
+                     InlineKeyboardButton("nächster Tag ▶️",
+                                          callback_data=encode(FETCH, conn_id, day + timedelta(1)))],
+                    [InlineKeyboardButton("⏪ vorherige Woche",
+                                          callback_data=encode(FETCH, conn_id, day + timedelta(-7))),
+                     InlineKeyboardButton("nächste Woche ⏩",
+                                          callback_data=encode(FETCH, conn_id, day + timedelta(7)))],
+                    [InlineKeyboardButton("📅 günstigster Tag (Woche)", callback_data=encode(RANGE, conn_id, 7)),
+                     InlineKeyboardButton("📅 günstigster Tag (4 Wochen)",
+                                          callback_data=encode(RANGE, conn_id, 28))]]
+    return InlineKeyboardMarkup([[button for button in row if button is not None] for row in button_list])
+
+
+def page_text(pages, page):
+    if len(pages) == 1:
+        return pages[0]
+    return pages[page] + "\n\n_Seite " + str(page + 1) + " von " + str(len(pages)) + "_"
+
+
+def RequestConnections(bot, update, usr, payload):
     s = DBSession()
-    conn = s.query(Connection).filter(Connection.user_id == usr.id, Connection.id == con).first()
+    conn = s.query(Connection).filter(Connection.user_id == usr.id, Connection.id == payload.target).first()
     if not conn:
-        button_list = [[InlineKeyboardButton("🏠 Home", callback_data="0")]]
+        button_list = [[InlineKeyboardButton("🏠 Home", callback_data=encode(HOME))]]
         send_or_edit(bot, update,
                      "Diese Verbindung kann nicht gefunden werden. Vielleicht liegt sie in der Vergangenheit.",
                      InlineKeyboardMarkup(button_list))
     else:
-        if len(args) > 2:
-            conn.date = datetime.strptime(args[2], "%d.%m.%Y").date()
+        if payload.extra is not None:
+            # only look at another day, the stored connection stays as it is
+            s.expunge(conn)
+            conn.date = payload.extra
         # now get all the data
         entries = reqcons(conn)
-        message = "Verbindungen von " + conn.start_name + " nach " + conn.dest_name + " am " + conn.date.strftime(
-            "%a, %d.%m.%Y") + ":\n"
-        if type(entries) is str:
-            message += entries
-        elif not entries:
-            message = "Keine Verbindungen unter diesen Kriterien gefunden."
+        if config['DEFAULT'].getboolean('Prefetch', fallback=True):
+            fares.prefetch(conn.start, conn.dest, [day for day in (conn.date + timedelta(1), conn.date + timedelta(-1))
+                                                   if day >= date.today()])
+        pages = paginate_connections(conn, entries)
+        key = None
+        if len(pages) > 1:
+            # the pages are kept here, so turning them doesn't ask the Bahn again; the chat always reaches the
+            # same worker, so a cache per process is enough
+            key = secrets.token_hex(4)
+            results.put(key, (usr.id, conn.id, conn.date, pages))
+        send_or_edit(bot, update, page_text(pages, 0), result_buttons(conn.id, conn.date, key, 0, len(pages)))
+
+
+def ShowPage(bot, update, usr, payload):
+    key, page = payload.extra
+    result = results.get(key)
+    if result is None or result[:2] != (usr.id, payload.target) or page >= len(result[3]):
+        button_list = [[InlineKeyboardButton("🔄 Neu abrufen", callback_data=encode(FETCH, payload.target)),
+                        InlineKeyboardButton("🏠 Home", callback_data=encode(HOME))]]
+        send_or_edit(bot, update, "Diese Ergebnisse sind nicht mehr aktuell, bitte rufe sie neu ab.",
+                     InlineKeyboardMarkup(button_list))
+        return
+    user_id, conn_id, day, pages = result
+    send_or_edit(bot, update, page_text(pages, page), result_buttons(conn_id, day, key, page, len(pages)))
+
+
+def format_calendar(conn, days, cheapest, grouped=True):
+    # one line per day with the cheapest fare, days still being looked up are marked
+    message = "Günstigste Tage von " + conn.start_name + " nach " + conn.dest_name + ":\n"
+    if not grouped:
+        message += "_ohne die weiteren Start- und Zielbahnhöfe_\n"
+    prices = [price for price in cheapest.values() if isinstance(price, Decimal)]
+    best = min(prices) if prices else None
+    for day in days:
+        price = cheapest.get(day, False)
+        if price is False:
+            value = "…"
+        elif price is None:
+            value = "-"
+        elif type(price) is str:
+            value = "Fehler"
         else:
-            for key, entry in sorted(entries.items()):
-                message += "*" + str(key) + "€*:\n"
-                for ent in entry:
-                    message += ent["start_time"] + " Uhr - " + ent["arrival_time"] + " Uhr (" + str(
-                        ent["duration"] // 60) + "h" + format(ent["duration"] % 60, '02d') + "min), " + str(
-                        ent["changes"]) + "x umsteigen, " + ent["class"] + ". Klasse\n"
-        button_list = [[InlineKeyboardButton("🚄 Verbindung", callback_data="1$" + str(conn.id)),
-                        InlineKeyboardButton("🏠 Home", callback_data="0")],
-                       [InlineKeyboardButton("◀️ vorheriger Tag", callback_data="9$" + str(conn.id) + "$" + (
-                       conn.date + timedelta(-1)).strftime(
-                           "%d.%m.%Y")),
-                        InlineKeyboardButton("nächster Tag ▶️", callback_data="9$" + str(conn.id) + "$" + (
-                        conn.date + timedelta(1)).strftime(
-                            "%d.%m.%Y"))],
-                       [InlineKeyboardButton("⏪ vorherige Woche", callback_data="9$" + str(conn.id) + "$" + (
-                       conn.date + timedelta(-7)).strftime(
-                           "%d.%m.%Y")),
-                        InlineKeyboardButton("nächste Woche ⏩", callback_data="9$" + str(conn.id) + "$" + (
-                        conn.date + timedelta(7)).strftime(
-                            "%d.%m.%Y"))]]
-        send_or_edit(bot, update, message, InlineKeyboardMarkup(button_list))
-    s.close()
+            value = str(price.quantize(Decimal('.01'))).replace(".", ",") + "€" + (" ⭐" if price == best else "")
+        message += day.strftime("%a, %d.%m.") + ": " + value + "\n"
+    if len(cheapest) < len(days):
+        message += "\n_" + str(len(cheapest)) + " von " + str(len(days)) + " Tagen abgefragt_"
+    return message
+
+
+def calendar_buttons(conn, cheapest):
+    # the three cheapest days open the fares of that day
+    best = sorted((price, day) for day, price in cheapest.items() if isinstance(price, Decimal))[:3]
+    button_list = [[InlineKeyboardButton(day.strftime("%d.%m.") + " " + str(price).replace(".", ",") + "€",
+                                         callback_data=encode(FETCH, conn.id, day)) for price, day in best]]
+    button_list.append([InlineKeyboardButton("🚄 Verbindung", callback_data=encode(SHOW, conn.id)),
+                        InlineKeyboardButton("🏠 Home", callback_data=encode(HOME))])
+    return InlineKeyboardMarkup([row for row in button_list if row])
+
+
+# station pairs times days of one range search, as many as the 28 days of a single pair; a station group that needs
+# more is searched with the stations of the connection only
+RANGE_LOOKUPS = 28
+
+
+def range_fits(starts, dests, days):
+    return sum(1 for start in starts for dest in dests if start != dest) * days <= RANGE_LOOKUPS
+
+
+def SearchRange(bot, update, usr, payload):
+    s = DBSession()
+    conn = s.query(Connection).filter(Connection.user_id == usr.id, Connection.id == payload.target).first()
+    if not conn:
+        button_list = [[InlineKeyboardButton("🏠 Home", callback_data=encode(HOME))]]
+        send_or_edit(bot, update,
+                     "Diese Verbindung kann nicht gefunden werden. Vielleicht liegt sie in der Vergangenheit.",
+                     InlineKeyboardMarkup(button_list))
+        return
+    if update.callback_query is None:
+        # a text message while the range search was the last selection, there is no message to update
+        ShowConnection(bot, update, usr, Payload(SHOW, conn.id, None))
+        return
+    # the lookups finish after this update is done, they only read the detached connection
+    s.expunge(conn)
+    first = max(conn.date, date.today())
+    days = [first + timedelta(i) for i in range(payload.extra or 7)]
+    chat_id = update.callback_query.message.chat.id
+    message_id = update.callback_query.message.message_id
+    cheapest = dict()
+    lock = threading.Lock()
+    starts, dests = station_ids(start_group(conn)), station_ids(dest_group(conn))
+    grouped = range_fits(starts, dests, len(days))
+    if not grouped:
+        starts, dests = [conn.start], [conn.dest]
+
+    def found(day, fares):
+        # edits of the same message are coalesced by the outbox, so fast days don't flood the chat
+        with lock:
+            cheapest[day] = cheapest_fare(fares, conn)
+            outbox.edit(chat_id, message_id, format_calendar(conn, days, cheapest, grouped),
+                        calendar_buttons(conn, cheapest))
+
+    send_or_edit(bot, update, format_calendar(conn, days, cheapest, grouped), calendar_buttons(conn, cheapest))
+    fares.fetch_range(starts, dests, days, found)
 
 
 def Gate(bot, update):
-    usr = CheckUser(bot, update)
-    if not update.callback_query is None:
-        args = update.callback_query.data.split("$")
-    else:
-        args = usr.current_selection.split("$")
-    if len(args) > 1:
-        if int(args[0]) == 1:  # show connection details
-            ShowConnection(bot, update, usr, args)
-        elif int(args[0]) == 2:  # create new or change start
-            SetStart(bot, update, usr, args)
-        elif int(args[0]) == 3:  # change destination
-            SetDest(bot, update, usr, args)
-        elif int(args[0]) == 4:  # change date
-            SetDate(bot, update, usr, args)
-        elif int(args[0]) == 5:  # change maxprice
-            SetPrice(bot, update, usr, args)
-        elif int(args[0]) == 6:  # change maxduration
-            SetDuration(bot, update, usr, args)
-        elif int(args[0]) == 7:  # change maxchanges
-            SetChanges(bot, update, usr, args)
-        elif int(args[0]) == 8:  # change notifications
-            SetNotifications(bot, update, usr, args)
-        elif int(args[0]) == 9:  # show currently available connections
-            RequestConnections(bot, update, usr, args)
-        elif int(args[0]) == 10:  # Delete
-            DeleteConnection(bot, update, usr, args)
-        else:
-            ShowHome(bot, update, usr)
-    else:
-        ShowHome(bot, update, usr)
+    # malformed callback data is rejected before any session is opened
+    payload = None
+    if update.callback_query is not None:
+        try:
+            payload = router.decode(update.callback_query.data)
+        except ValueError:
+            logging.warning("Ignoring malformed callback data %r", update.callback_query.data)
+            return
+    # all handlers of one update share a single session, committed once at the end
+    try:
+        with span("update", action=payload.action if payload is not None else "message"):
+            Dispatch(bot, update, payload)
+            with span("db_commit"):
+                DBSession.commit()
+    except Exception:
+        DBSession.rollback()
+        raise
+    finally:
+        DBSession.remove()
+
+
+def Dispatch(bot, update, payload):
+    usr, selection = CheckUser(bot, update)
+    if payload is None and is_import(update.message.text or ""):
+        payload = Payload(IMPORT, -1, None)
+    if payload is None:
+        try:
+            payload = router.decode(selection)
+        except ValueError:
+            payload = Payload(HOME, None, None)
+    router.dispatch(bot, update, usr, payload)
+
+
+router = Router()
+router.register(HOME, ShowHome)
+router.register(SHOW, ShowConnection)  # show connection details
+router.register(START, SetStart)  # create new or change start
+router.register(DEST, SetDest)  # change destination
+router.register(DATE, SetDate)  # change date
+router.register(PRICE, SetPrice)  # change maxprice
+router.register(DURATION, SetDuration)  # change maxduration
+router.register(CHANGES, SetChanges)  # change maxchanges
+router.register(NOTIFY, SetNotifications, extra=choice(0, 1, 2))  # change notifications
+router.register(FETCH, RequestConnections, extra=parse_date)  # show currently available connections
+router.register(DELETE, DeleteConnection, extra=choice(1))
+router.register(RANGE, SearchRange, extra=choice(7, 28))  # cheapest day of the next days
+router.register(PAGE, ShowPage, extra=parse_page)  # another page of the last results
+router.register(IMPORT, ImportWatches)  # several new connections from one message
+router.register(GROUP, SetGroup, extra=choice(0, 1, 2))  # further start or destination stations
+
+
+def UseLocale():
+    # German weekday names in the results, but don't refuse to start on hosts without the locale
+    for name in ("de_DE.UTF-8", "de_DE.utf8", "de_DE"):
+        try:
+            return setlocale(LC_ALL, name)
+        except LocaleError:
+            pass
+    logging.warning("German locale is not available, weekdays will be shown in English")
+
+
+def init(path='config/config.ini', bot=None):
+    # application factory: reads the config and creates all components without starting any thread or
+    # network connection, so the bot can also be driven by tests and benchmarks with a fake bot
+    global engine, SessionFactory, updater, outbox, stations, prices, fares, watcher, maintenance, runtime
+    global startup_time, store, results
+    started = time.perf_counter()
+    config.read(path)
+    UseLocale()
+    if config['DEFAULT'].getint('Workers', fallback=0) > 0:
+        store = SharedStore(config['DEFAULT'].get('SharedStore', fallback='config/shared.sqlite'))
+    engine = create_db_engine(config['DEFAULT'].get('Database', fallback='sqlite:///config/bahn.sqlite'))
+    migrate(engine)
+    Base.metadata.bind = engine
+    SessionFactory = sessionmaker(bind=engine)
+    DBSession.configure(bind=engine)
+    if bot is None:
+        from telegram.ext import Updater
+        updater = Updater(token=config['DEFAULT']['BotToken'])
+        bot = updater.bot
+    # Telegram allows about 30 messages per second for the whole bot, not per process
+    outbox = Outbox(bot, on_unauthorized=RemoveUser, on_migrated=MigrateUser,
+                    limiter=SharedRateLimiter(store, "telegram", 30 * 60, burst=30) if store is not None else None)
+    stations = StationFinder(SessionFactory, upstream=UseUpstream("reiseauskunft.bahn.de", read_timeout=5))
+    prices = PriceRecorder(engine)
+    size = config['DEFAULT'].getint('CacheSize', fallback=256)
+    ttl = config['DEFAULT'].getint('CacheTTL', fallback=300)
+    max_stale = config['DEFAULT'].getint('MaxStale', fallback=21600)
+    fares = FareClient(cache=SharedCache(store, size, ttl, max_stale) if store is not None else TTLCache(size, ttl),
+                       observer=prices.record, range_workers=config['DEFAULT'].getint('RangeWorkers', fallback=4),
+                       upstream=UseUpstream("ps.bahn.de"), max_stale=max_stale,
+                       group_workers=config['DEFAULT'].getint('GroupWorkers', fallback=4))
+    results = TTLCache(1024, config['DEFAULT'].getint('ResultTTL', fallback=1800))
+    # notifications about outdated fares would be misleading, so the watcher doesn't get stale ones
+    watcher = Watcher(outbox, SessionFactory,
+                      lambda starts, dests, day: fares.fetch_group(starts, dests, day, stale=False),
+                      format_connections,
+                      JobQueue(engine, visibility=config['DEFAULT'].getint('JobVisibility', fallback=600),
+                               attempts=config['DEFAULT'].getint('JobAttempts', fallback=5),
+                               backoff=config['DEFAULT'].getint('JobBackoff', fallback=60)),
+                      workers=config['DEFAULT'].getint('WatcherWorkers', fallback=4),
+                      rate=config['DEFAULT'].getfloat('WatcherRate', fallback=30),
+                      drop=int(Decimal(config['DEFAULT'].get('NotifyDrop', fallback='0')) * 100))
+    maintenance = Maintenance(engine, retention=config['DEFAULT'].getint('RetentionDays', fallback=1),
+                              archive=config['DEFAULT'].getboolean('ArchiveConnections', fallback=True),
+                              queue=watcher.queue,
+                              price_retention=config['DEFAULT'].getint('PriceRetentionDays', fallback=90))
+    if config['DEFAULT'].get('Runtime', fallback='threads') == 'asyncio':
+        from aio import AsyncRuntime
+        runtime = AsyncRuntime(Gate, SessionFactory, fares, stations, router)
+    Instrument()
+    startup_time = time.perf_counter() - started
+    logging.info("Initialised in %.0f ms", startup_time * 1000)
+
+
+def UseUpstream(name, read_timeout=10):
+    rate = config['DEFAULT'].getfloat('UpstreamRate', fallback=600)
+    return Upstream(name, rate=rate, limiter=SharedRateLimiter(store, name, rate, 10) if store is not None else None,
+                    concurrency=config['DEFAULT'].getint('UpstreamConcurrency', fallback=8),
+                    failures=config['DEFAULT'].getint('BreakerFailures', fallback=5),
+                    reset=config['DEFAULT'].getint('BreakerReset', fallback=30),
+                    read_timeout=config['DEFAULT'].getfloat('UpstreamTimeout', fallback=read_timeout))
+
 
+def Instrument():
+    transactions = REGISTRY.counter("db_transactions_total", "Database transactions started")
+    event.listen(engine, "begin", lambda conn: transactions.inc())
+    REGISTRY.gauge("outbox", "Messages in the outbox and delivery counters",
+                   lambda: {(("kind", key),): value for key, value in outbox.stats().items()})
+    REGISTRY.gauge("fare_cache", "Entries, hits and misses of the fare cache",
+                   lambda: {(("kind", key),): value for key, value in fares.cache.stats().items()})
+    REGISTRY.gauge("watcher_fetches", "Upstream lookups of the watcher, saved ones by sharing a route",
+                   lambda: {(("kind", "done"),): watcher.fetches, (("kind", "saved"),): watcher.saved_fetches})
+    REGISTRY.gauge("jobs", "Watcher checks in the job queue by state and the age of the oldest unfinished one",
+                   lambda: {(("kind", key),): value for key, value in watcher.queue.stats().items()})
+    upstreams = [fares.upstream, stations.upstream]
+    REGISTRY.gauge("upstream_open", "1 while the circuit breaker of the service is open or half open",
+                   lambda: {(("upstream", u.name),): int(u.breaker.state != "closed") for u in upstreams})
+    REGISTRY.gauge("upstream_limit", "Current adaptive limit of concurrent requests to the service",
+                   lambda: {(("upstream", u.name),): round(u.limit.limit, 2) for u in upstreams})
+
+
+def UseLogging(level=logging.INFO):
+    # handlers only put records into a queue, a listener thread formats and writes them
+    records = queue.Queue(-1)
+    output = logging.StreamHandler()
+    output.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(records)]
+    root.setLevel(level)
+    listener.start()
+    return listener
+
+
+def CheckDatabase():
+    with engine.connect() as conn:
+        conn.execute("SELECT 1")
+    return True, "ok"
+
+
+def CheckOutbox():
+    stats = outbox.stats()
+    # a queue that hasn't moved for a few minutes means Telegram can't be reached
+    return outbox.thread.is_alive() and stats["oldest"] < 300, stats
+
+
+def CheckStartup():
+    return startup_time is not None, {"startup_ms": round(startup_time * 1000) if startup_time else None}
+
+
+def StartHealth(checks, offset=0):
+    # the processes of the multi-process mode use the ports after HealthPort
+    if 'HealthPort' not in config['DEFAULT']:
+        return None
+    health = HealthServer(checks, config['DEFAULT'].getint('HealthPort') + offset, metrics=REGISTRY.render)
+    health.start()
+    return health
+
+
+def UseLogLevel():
+    logging.getLogger().setLevel(config['DEFAULT'].get('LogLevel', fallback='INFO').upper())
+
+
+def AddHandlers(dispatcher, handler):
+    from telegram.ext import CallbackQueryHandler
+    from telegram.ext import CommandHandler
+    from telegram.ext import Filters
+    from telegram.ext import MessageHandler
+
+    inlinehandler = CallbackQueryHandler(handler)
+    dispatcher.add_handler(inlinehandler)
+
+    starthandler = CommandHandler('start', handler)
+    dispatcher.add_handler(starthandler)
+
+    importhandler = CommandHandler('import', handler)
+    dispatcher.add_handler(importhandler)
+
+    msghandler = MessageHandler(Filters.text, handler)
+    dispatcher.add_handler(msghandler)
+
+
+def RunLane(updates, bot):
+    while True:
+        update = updates.get()
+        if update is None:
+            return
+        try:
+            Gate(bot, update)
+        except Exception:
+            logging.exception("Handling update %s failed", update.update_id)
+
+
+def RunWorker(path, index, count, updates):
+    # worker process: handles the updates of its chats, every chat always in the same lane thread
+    # Ctrl+C reaches the whole process group, the front process stops the workers in order
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    listener = UseLogging()
+    init(path)
+    UseLogLevel()
+    bot = outbox.bot
+    outbox.start()
+    prices.start()
+    health = StartHealth({"startup": CheckStartup, "database": CheckDatabase, "outbox": CheckOutbox}, 1 + index)
+    lanes = [queue.Queue() for _ in range(config['DEFAULT'].getint('WorkerThreads', fallback=4))]
+    threads = [threading.Thread(target=RunLane, args=(lane, bot), name="lane-%d" % i) for i, lane in enumerate(lanes)]
+    for thread in threads:
+        thread.start()
+    while True:
+        data = updates.get()
+        if data is None:
+            break
+        update = telegram.Update.de_json(data, bot)
+        chat = update.effective_chat
+        lanes[shard(chat.id // count if chat is not None else 0, len(lanes))].put(update)
+    for lane in lanes:
+        lane.put(None)
+    for thread in threads:
+        thread.join()
+    outbox.stop()
+    prices.stop()
+    if health is not None:
+        health.stop()
+    listener.stop()
+
+
+def RunChecker(path, stopped):
+    # checker process: notifications and maintenance, so fare checks never hold up interactive updates
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    listener = UseLogging()
+    init(path)
+    UseLogLevel()
+    outbox.start()
+    prices.start()
+    health = StartHealth({"startup": CheckStartup, "database": CheckDatabase, "outbox": CheckOutbox},
+                         1 + config['DEFAULT'].getint('Workers'))
+    watcher.start()
+    maintenance.start()
+    stopped.wait()
+    maintenance.stop()
+    watcher.stop()
+    outbox.stop()
+    prices.stop()
+    if health is not None:
+        health.stop()
+    listener.stop()
+
+
+def RunSharded(path, count):
+    # front process: receives the webhook and hands each update to the worker process of its chat
+    from telegram.ext import Updater
+    front = Updater(token=config['DEFAULT']['BotToken'])
+    # migrate once before the processes open the database
+    migrate(create_db_engine(config['DEFAULT'].get('Database', fallback='sqlite:///config/bahn.sqlite')))
+    shards = ShardRouter(multiprocessing.get_context("spawn"), count, RunWorker, RunChecker, (path,))
+    shards.start()
+    AddHandlers(front.dispatcher, shards.forward)
+
+    def CheckProcesses():
+        alive = shards.alive()
+        return all(alive.values()), alive
+
+    health = StartHealth({"processes": CheckProcesses})
+    front.start_webhook(listen='localhost', port=int(config['DEFAULT']['Port']),
+                        webhook_url=config['DEFAULT']['WebHookUrl'])
+    front.bot.setWebhook(webhook_url=config['DEFAULT']['WebHookUrl'])
+    front.idle()
+    front.stop()
+    shards.stop()
+    if health is not None:
+        health.stop()
+
+
+def main(path='config/config.ini'):
+    listener = UseLogging()
+    config.read(path)
+    UseLogLevel()
+    count = config['DEFAULT'].getint('Workers', fallback=0)
+    if count > 0:
+        RunSharded(path, count)
+        listener.stop()
+        return
+    init(path)
+    if runtime is not None:
+        runtime.start()
+        handler = runtime.submit
+    else:
+        handler = Gate
+    AddHandlers(updater.dispatcher, handler)
 
-inlinehandler = CallbackQueryHandler(Gate)
-dispatcher.add_handler(inlinehandler)
+    outbox.start()
+    prices.start()
+    health = StartHealth({"startup": CheckStartup, "database": CheckDatabase, "outbox": CheckOutbox})
 
-starthandler = CommandHandler('start', Gate)
-dispatcher.add_handler(starthandler)
+    updater.start_webhook(listen='localhost', port=int(config['DEFAULT']['Port']),
+                          webhook_url=config['DEFAULT']['WebHookUrl'])
+    updater.bot.setWebhook(webhook_url=config['DEFAULT']['WebHookUrl'])
+    watcher.start()
+    maintenance.start()
+    updater.idle()
+    maintenance.stop()
+    if runtime is not None:
+        runtime.stop()
+    watcher.stop()
+    outbox.stop()
+    prices.stop()
+    if health is not None:
+        health.stop()
+    updater.stop()
+    listener.stop()
 
-msghandler = MessageHandler(Filters.text, Gate)
-dispatcher.add_handler(msghandler)
 
-updater.start_webhook(listen='localhost', port=int(config['DEFAULT']['Port']),
-                      webhook_url=config['DEFAULT']['WebHookUrl'])
-updater.bot.setWebhook(webhook_url=config['DEFAULT']['WebHookUrl'])
-updater.idle()
-updater.stop()
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,23 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 # created by Alwin Ebermann (alwin@alwin.net.au)
+import json
 
 from sqlalchemy import Column
 from sqlalchemy import Date
 from sqlalchemy import Integer
+from sqlalchemy import SmallInteger
 from sqlalchemy import Float
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
 from sqlalchemy import String
+from sqlalchemy import Text
 from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import QueuePool
 
 Base = declarative_base()
 
@@ -27,9 +34,48 @@ class Connection(Base):
     maxchanges = Column(Integer, default=10)
     maxprice = Column(Float(asdecimal=True), default=200)
     notifications = Column(Integer, default=2)
+    # fingerprint and cheapest price (in cents) of the offers of the last notification
+    notified_hash = Column(String(16), nullable=True)
+    notified_cents = Column(Integer, nullable=True)
+    # further start and destination stations searched together with start and dest, JSON lists of [ext_id, name]
+    start_group = Column(Text, nullable=True)
+    dest_group = Column(Text, nullable=True)
     # relation to user
     user_id = Column(Integer, ForeignKey('user.id'))
     user = relationship("User", back_populates="connection")
+    # AUTOINCREMENT: ids of archived connections are never given out again, they stay unique in the archive
+    # and in the keys of queued checks
+    __table_args__ = (Index('ix_connection_user_date', 'user_id', 'date'),
+                      Index('ix_connection_date_notifications', 'date', 'notifications'),
+                      {'sqlite_autoincrement': True})
+
+class ArchivedConnection(Base):
+    __tablename__ = 'connection_archive'
+    id = Column(Integer, primary_key=True)
+    date = Column(Date, nullable=False)
+    start = Column(String(9), nullable=False)
+    start_name = Column(String(250), nullable=False)
+    dest = Column(String(9), nullable=False)
+    dest_name = Column(String(250), nullable=False)
+    maxduration = Column(Integer)
+    maxchanges = Column(Integer)
+    maxprice = Column(Float(asdecimal=True))
+    notifications = Column(Integer)
+    user_id = Column(Integer, index=True)
+
+class Price(Base):
+    # one row per observed fare, prices in cents and departures in minutes since midnight
+    __tablename__ = 'price'
+    id = Column(Integer, primary_key=True)
+    start = Column(String(9), nullable=False)
+    dest = Column(String(9), nullable=False)
+    day = Column(Date, nullable=False)
+    departure = Column(SmallInteger, nullable=False)
+    klass = Column(SmallInteger, nullable=False)
+    cents = Column(Integer, nullable=False)
+    observed = Column(Date, nullable=False)
+    # covers the per day statistics, so they are answered from the index alone and already sorted by price
+    __table_args__ = (Index('ix_price_route', 'start', 'dest', 'day', 'cents', 'observed'),)
 
 class User(Base):
     __tablename__ = 'user'
@@ -42,5 +88,116 @@ class User(Base):
     connection = relationship("Connection", back_populates="user")
     counter = Column(Integer, nullable=True)
 
-engine = create_engine('sqlite:///config/bahn.sqlite')
-Base.metadata.create_all(engine)
+class Job(Base):
+    # durable queue of watcher checks, see jobs.JobQueue; times are epoch seconds
+    __tablename__ = 'job'
+    id = Column(Integer, primary_key=True)
+    # e.g. the check of a connection in one interval, a key is only queued once
+    key = Column(String(64), nullable=False, unique=True)
+    payload = Column(Text, nullable=False)
+    # "ready" until it is "done" or, after too many attempts, "dead"
+    state = Column(String(5), nullable=False)
+    created = Column(Float, nullable=False)
+    # not leased before: the end of the retry backoff or of the visibility timeout of the current lease
+    available = Column(Float, nullable=False)
+    lease = Column(String(32), nullable=True)
+    attempts = Column(Integer, nullable=False)
+    finished = Column(Float, nullable=True)
+    __table_args__ = (Index('ix_job_state_available', 'state', 'available'),)
+
+class Station(Base):
+    __tablename__ = 'station'
+    ext_id = Column(String(9), primary_key=True)
+    value = Column(String(250), nullable=False)
+    # normalized value for exact and prefix lookups
+    name = Column(String(250), nullable=False, index=True)
+
+class StationAlias(Base):
+    __tablename__ = 'station_alias'
+    # normalized input of a user
+    name = Column(String(250), primary_key=True)
+    ext_id = Column(String(9), ForeignKey('station.ext_id'), nullable=False)
+    station = relationship("Station")
+
+# schema changes for existing databases, the position in the list is stored as PRAGMA user_version
+MIGRATIONS = [
+    ["CREATE INDEX IF NOT EXISTS ix_connection_user_date ON connection (user_id, date)",
+     "CREATE INDEX IF NOT EXISTS ix_connection_date_notifications ON connection (date, notifications)"],
+    ["ALTER TABLE connection ADD COLUMN notified_hash VARCHAR(16)",
+     "ALTER TABLE connection ADD COLUMN notified_cents INTEGER"],
+    ["ALTER TABLE connection ADD COLUMN start_group TEXT",
+     "ALTER TABLE connection ADD COLUMN dest_group TEXT"],
+    # SQLite can only add AUTOINCREMENT by building the table again. Connections that already got the id of an
+    # archived one are moved behind all used ids, and the sequence starts after the archived ids.
+    ["UPDATE connection SET id = id + (SELECT max(m) FROM (SELECT max(id) AS m FROM connection UNION ALL "
+     "SELECT max(id) FROM connection_archive)) WHERE id IN (SELECT id FROM connection_archive)",
+     "CREATE TABLE connection_new (id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, date DATE NOT NULL, "
+     "start VARCHAR(9) NOT NULL, start_name VARCHAR(250) NOT NULL, dest VARCHAR(9) NOT NULL, "
+     "dest_name VARCHAR(250) NOT NULL, maxduration INTEGER, maxchanges INTEGER, maxprice FLOAT, "
+     "notifications INTEGER, notified_hash VARCHAR(16), notified_cents INTEGER, start_group TEXT, "
+     "dest_group TEXT, user_id INTEGER, FOREIGN KEY(user_id) REFERENCES user (id))",
+     "INSERT INTO connection_new (id, date, start, start_name, dest, dest_name, maxduration, maxchanges, maxprice, "
+     "notifications, notified_hash, notified_cents, start_group, dest_group, user_id) SELECT id, date, start, "
+     "start_name, dest, dest_name, maxduration, maxchanges, maxprice, notifications, notified_hash, "
+     "notified_cents, start_group, dest_group, user_id FROM connection",
+     "DROP TABLE connection",
+     "ALTER TABLE connection_new RENAME TO connection",
+     "CREATE INDEX ix_connection_user_date ON connection (user_id, date)",
+     "CREATE INDEX ix_connection_date_notifications ON connection (date, notifications)",
+     "DELETE FROM sqlite_sequence WHERE name = 'connection'",
+     "INSERT INTO sqlite_sequence (name, seq) SELECT 'connection', coalesce(max(m), 0) FROM "
+     "(SELECT max(id) AS m FROM connection UNION ALL SELECT max(id) FROM connection_archive)"],
+    ["DROP INDEX IF EXISTS ix_price_route",
+     "CREATE INDEX ix_price_route ON price (start, dest, day, cents, observed)"],
+]
+
+# stations of a group including the own one, so a search asks for at most GROUP_SIZE ** 2 pairs
+GROUP_SIZE = 4
+
+
+def start_group(connection):
+    # [(ext_id, name)] of all start stations, the one of the connection first
+    return [(connection.start, connection.start_name)] + [tuple(station) for station in
+                                                          json.loads(connection.start_group or "[]")]
+
+
+def dest_group(connection):
+    return [(connection.dest, connection.dest_name)] + [tuple(station) for station in
+                                                        json.loads(connection.dest_group or "[]")]
+
+
+def create_db_engine(url='sqlite:///config/bahn.sqlite', busy_timeout=5000):
+    # the connection settings, the migrations (PRAGMA user_version) and the job queue (INSERT OR IGNORE) are SQLite
+    backend = make_url(url).get_backend_name()
+    if backend != 'sqlite':
+        raise RuntimeError("Database must be a SQLite URL, not %s" % backend)
+    engine = create_engine(url, poolclass=QueuePool, pool_size=5, max_overflow=10,
+                           connect_args={'check_same_thread': False})
+
+    @event.listens_for(engine, "connect")
+    def tune(dbapi_connection, connection_record):
+        # WAL lets readers continue while a handler writes, NORMAL is safe in WAL mode and saves an fsync per commit
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA busy_timeout=%d" % busy_timeout)
+        cursor.close()
+
+    return engine
+
+
+def migrate(engine):
+    # a new database is created with the current schema and needs no migrations
+    new = not engine.dialect.has_table(engine, Connection.__tablename__)
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        version = len(MIGRATIONS) if new else conn.execute("PRAGMA user_version").scalar()
+        for statements in MIGRATIONS[version:]:
+            for statement in statements:
+                conn.execute(statement)
+        if new or version < len(MIGRATIONS):
+            conn.execute("PRAGMA user_version=%d" % len(MIGRATIONS))
+
+
+def station_ids(group):
+    return [ext_id for ext_id, name in group]
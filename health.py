@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+
+class HealthServer(object):
+    # local HTTP endpoint: /health answers as long as the process runs, /ready runs all checks and /metrics
+    # returns the metrics in the Prometheus text format
+    def __init__(self, checks, port, host='localhost', metrics=None):
+        # checks maps a name to a function returning (ok, details), metrics returns the text of /metrics
+        self.checks = checks
+        self.metrics = metrics
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path == "/health":
+                    self.reply(200, {"status": "ok"})
+                elif self.path == "/ready":
+                    ready, report = server.report()
+                    self.reply(200 if ready else 503, report)
+                elif self.path == "/metrics" and server.metrics is not None:
+                    data = server.metrics().encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                else:
+                    self.send_error(404)
+
+            def reply(self, status, body):
+                data = json.dumps(body, default=str).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="health", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def report(self):
+        ready = True
+        report = dict()
+        for name, check in self.checks.items():
+            try:
+                ok, details = check()
+            except Exception as e:
+                logger.warning("Readiness check %s failed", name, exc_info=True)
+                ok, details = False, str(e)
+            ready = ready and ok
+            report[name] = {"ok": ok, "details": details}
+        report["ready"] = ready
+        return ready, report
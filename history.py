@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import logging
+import threading
+from collections import OrderedDict
+from datetime import date
+
+from sqlalchemy import select
+
+from bahn import timetomin
+from db import Price
+
+logger = logging.getLogger(__name__)
+
+
+class PriceRecorder(object):
+    # collects observed fares and writes them with one bulk insert per batch
+    def __init__(self, engine, batch=500, interval=30):
+        self.engine = engine
+        self.batch = batch
+        self.interval = interval
+        self.rows = []
+        self.lock = threading.Lock()
+        self.written = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="history", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.flush()
+
+    def record(self, start, dest, day, fares):
+        today = date.today()
+        rows = [{"start": start, "dest": dest, "day": day, "departure": timetomin(fare.start_time),
+                 "klass": int(fare.klass), "cents": int(fare.price * 100), "observed": today}
+                for fare in fares if fare.price]
+        with self.lock:
+            self.rows.extend(rows)
+            full = len(self.rows) >= self.batch
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            rows, self.rows = self.rows, []
+        if not rows:
+            return
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(Price.__table__.insert(), rows)
+            self.written += len(rows)
+        except Exception:
+            logger.exception("Writing %d prices failed", len(rows))
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+
+
+def daily_prices(conn, start, dest, first, last, since=None):
+    # travel day -> (min, median) price in cents for a route, read from ix_price_route in price order
+    table = Price.__table__
+    query = select([table.c.day, table.c.cents]).where(table.c.start == start).where(table.c.dest == dest) \
+        .where(table.c.day.between(first, last))
+    if since is not None:
+        query = query.where(table.c.observed >= since)
+    days = OrderedDict()
+    for day, cents in conn.execute(query.order_by(table.c.day, table.c.cents)):
+        days.setdefault(day, []).append(cents)
+    return OrderedDict((day, (prices[0], median(prices))) for day, prices in days.items())
+
+
+def median(prices):
+    # prices are sorted already
+    middle = len(prices) // 2
+    if len(prices) % 2:
+        return prices[middle]
+    return (prices[middle - 1] + prices[middle]) // 2
@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import json
+import logging
+import threading
+import time
+from collections import namedtuple
+from uuid import uuid4
+
+from sqlalchemy import and_
+from sqlalchemy import func
+from sqlalchemy import select
+
+from db import Job
+
+READY = "ready"
+DONE = "done"
+DEAD = "dead"
+
+logger = logging.getLogger(__name__)
+
+# a job handed to a worker, payload is decoded already
+Lease = namedtuple("Lease", ["id", "key", "payload", "attempts"])
+
+
+class JobQueue(object):
+    # Jobs in the job table of the bot database. A leased job is invisible for visibility seconds; if it is neither
+    # done nor failed by then (the process died), it is leased again, so every job runs at least once. Failed jobs
+    # come back after an exponential backoff until attempts runs out. Completions are written in batches.
+    def __init__(self, engine, visibility=600, attempts=5, backoff=60, batch=100, keep=8 * 24 * 3600):
+        self.engine = engine
+        self.visibility = visibility
+        self.attempts = attempts
+        self.backoff = backoff
+        self.batch = batch
+        # finished jobs are kept this long, their keys stop the same check from being queued again
+        self.keep = keep
+        self.completed = []
+        self.lock = threading.Lock()
+
+    def enqueue(self, jobs):
+        # jobs are (key, payload) pairs, keys that are queued already are skipped
+        now = time.time()
+        rows = [{"key": key, "payload": json.dumps(payload), "state": READY, "created": now, "available": now,
+                 "attempts": 0} for key, payload in jobs]
+        if not rows:
+            return
+        with self.engine.begin() as conn:
+            conn.execute(Job.__table__.insert().prefix_with("OR IGNORE"), rows)
+
+    def lease(self, limit):
+        # a single UPDATE takes the jobs, so two processes never lease the same one
+        if limit <= 0:
+            return []
+        table = Job.__table__
+        now = time.time()
+        token = uuid4().hex
+        waiting = select([table.c.id]).where(and_(table.c.state == READY, table.c.available <= now)) \
+            .order_by(table.c.available).limit(limit)
+        with self.engine.begin() as conn:
+            # jobs whose every lease ran out, e.g. because they take the process down with them
+            conn.execute(table.update().where(and_(table.c.state == READY, table.c.available <= now,
+                                                   table.c.attempts >= self.attempts)).values(
+                state=DEAD, finished=now, lease=None))
+            conn.execute(table.update().where(table.c.id.in_(waiting)).values(
+                lease=token, available=now + self.visibility, attempts=table.c.attempts + 1))
+            rows = conn.execute(select([table.c.id, table.c.key, table.c.payload, table.c.attempts])
+                                .where(table.c.lease == token)).fetchall()
+        return [Lease(id, key, json.loads(payload), attempts) for id, key, payload, attempts in rows]
+
+    def done(self, jobs):
+        with self.lock:
+            self.completed.extend(job.id for job in jobs)
+            full = len(self.completed) >= self.batch
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            ids, self.completed = self.completed, []
+        if not ids:
+            return
+        table = Job.__table__
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(table.update().where(and_(table.c.id.in_(ids), table.c.state == READY)).values(
+                    state=DONE, finished=time.time(), lease=None))
+        except Exception:
+            # they are leased again once their lease runs out
+            logger.exception("Completing %d jobs failed", len(ids))
+
+    def fail(self, jobs):
+        # try again after backoff, 2 * backoff, 4 * backoff, ... and give up after attempts
+        table = Job.__table__
+        now = time.time()
+        with self.engine.begin() as conn:
+            for job in jobs:
+                if job.attempts >= self.attempts:
+                    logger.warning("Giving up job %s after %d attempts", job.key, job.attempts)
+                    values = {"state": DEAD, "finished": now, "lease": None}
+                else:
+                    values = {"available": now + self.backoff * 2 ** (job.attempts - 1), "lease": None}
+                conn.execute(table.update().where(table.c.id == job.id).values(**values))
+
+    def release(self, jobs):
+        # unfinished jobs of a stopping worker, available again at once and without counting the attempt
+        table = Job.__table__
+        if not jobs:
+            return
+        with self.engine.begin() as conn:
+            conn.execute(table.update().where(and_(table.c.id.in_([job.id for job in jobs]),
+                                                   table.c.state == READY)).values(
+                available=time.time(), lease=None, attempts=table.c.attempts - 1))
+
+    def purge(self):
+        table = Job.__table__
+        with self.engine.begin() as conn:
+            return conn.execute(table.delete().where(and_(table.c.state != READY,
+                                                          table.c.finished < time.time() - self.keep))).rowcount
+
+    def stats(self):
+        # jobs per state, ready ones split into waiting and leased, and the age of the oldest unfinished job
+        table = Job.__table__
+        now = time.time()
+        counts = {READY: 0, "leased": 0, DONE: 0, DEAD: 0}
+        leased = and_(table.c.lease.isnot(None), table.c.available > now)
+        with self.engine.connect() as conn:
+            for state, is_leased, count in conn.execute(
+                    select([table.c.state, leased, func.count()]).group_by(table.c.state, leased)):
+                counts["leased" if state == READY and is_leased else state] += count
+            oldest = conn.execute(select([func.min(table.c.created)]).where(table.c.state == READY)).scalar()
+        counts["oldest_age"] = round(now - oldest, 1) if oldest is not None else 0
+        return counts
@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import logging
+import threading
+from datetime import date
+from datetime import timedelta
+
+from sqlalchemy import select
+
+from db import ArchivedConnection
+from db import Connection
+from db import Price
+
+logger = logging.getLogger(__name__)
+
+
+def purge(engine, retention=1, archive=True, batch=500, pause=0.1, stopped=None):
+    # moves connections older than retention days to connection_archive (or deletes them), one short
+    # transaction per batch so handlers never wait long for the write lock
+    cutoff = date.today() - timedelta(retention)
+    table = Connection.__table__
+    columns = [table.c[column.name] for column in ArchivedConnection.__table__.columns]
+    counts = {"archived": 0, "deleted": 0, "batches": 0}
+    while stopped is None or not stopped.is_set():
+        with engine.begin() as conn:
+            ids = [row[0] for row in conn.execute(select([table.c.id]).where(table.c.date < cutoff).limit(batch))]
+            if not ids:
+                break
+            if archive:
+                conn.execute(ArchivedConnection.__table__.insert().from_select(
+                    [column.name for column in columns], select(columns).where(table.c.id.in_(ids))))
+                counts["archived"] += len(ids)
+            conn.execute(table.delete().where(table.c.id.in_(ids)))
+        counts["deleted"] += len(ids)
+        counts["batches"] += 1
+        if len(ids) < batch or (stopped is not None and stopped.wait(pause)):
+            break
+    return counts
+
+
+def purge_prices(engine, retention=90, batch=500, pause=0.1, stopped=None):
+    # deletes prices observed more than retention days ago, in batches like purge. Prices are inserted in the
+    # order they are observed, so the old ones come first in rowid order and no batch scans the whole table.
+    cutoff = date.today() - timedelta(retention)
+    table = Price.__table__
+    counts = {"deleted": 0, "batches": 0}
+    while stopped is None or not stopped.is_set():
+        with engine.begin() as conn:
+            ids = [row[0] for row in conn.execute(select([table.c.id]).where(table.c.observed < cutoff)
+                                                  .order_by(table.c.id).limit(batch))]
+            if not ids:
+                break
+            conn.execute(table.delete().where(table.c.id.in_(ids)))
+        counts["deleted"] += len(ids)
+        counts["batches"] += 1
+        if len(ids) < batch or (stopped is not None and stopped.wait(pause)):
+            break
+    return counts
+
+
+class Maintenance(object):
+    def __init__(self, engine, retention=1, archive=True, batch=500, interval=3600, queue=None, price_retention=90):
+        self.engine = engine
+        # job queue whose old finished jobs are removed as well
+        self.queue = queue
+        self.retention = retention
+        self.price_retention = price_retention
+        self.archive = archive
+        self.batch = batch
+        self.interval = interval
+        self.last = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="maintenance", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while True:
+            try:
+                self.last = purge(self.engine, self.retention, self.archive, self.batch, stopped=self.stopped)
+                if self.last["deleted"]:
+                    logger.info("Purged %(deleted)d past connections (%(archived)d archived) in %(batches)d batches",
+                                self.last)
+            except Exception:
+                logger.exception("Purging past connections failed")
+            try:
+                counts = purge_prices(self.engine, self.price_retention, self.batch, stopped=self.stopped)
+                if counts["deleted"]:
+                    logger.info("Purged %(deleted)d old prices in %(batches)d batches", counts)
+            except Exception:
+                logger.exception("Purging old prices failed")
+            if self.queue is not None:
+                try:
+                    self.queue.purge()
+                except Exception:
+                    logger.exception("Purging finished jobs failed")
+            if self.stopped.wait(self.interval):
+                return
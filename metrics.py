@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# upper bounds in seconds, from a cached lookup to a slow Bahn answer
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('%s="%s"' % (key, value.replace('"', '\\"')) for key, value in pairs) + "}"
+
+
+class Counter(object):
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = dict()
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s counter" % self.name]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append("%s%s %s" % (self.name, format_labels(key), value))
+        return lines
+
+
+class Histogram(object):
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # labels -> [count per bucket (last one is +Inf), sum]
+        self.values = dict()
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = label_key(labels)
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][i] += 1
+            entry[1] += value
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += count
+                    lines.append("%s_bucket%s %d" % (self.name, format_labels(key, [("le", str(bound))]), cumulative))
+                lines.append("%s_sum%s %f" % (self.name, format_labels(key), total))
+                lines.append("%s_count%s %d" % (self.name, format_labels(key), cumulative))
+        return lines
+
+
+class Gauge(object):
+    # read when scraped, fn returns a number or a dict of labels tuple -> number
+    def __init__(self, name, help, fn):
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s gauge" % self.name]
+        values = self.fn()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in sorted(values.items()):
+            lines.append("%s%s %s" % (self.name, format_labels(key), value))
+        return lines
+
+
+class Registry(object):
+    def __init__(self, prefix="bahnbot_"):
+        self.prefix = prefix
+        self.metrics = dict()
+        self.lock = threading.Lock()
+        self.spans = self.histogram("span_seconds", "Duration of instrumented operations")
+        self.errors = self.counter("span_errors_total", "Instrumented operations that raised an exception")
+
+    def add(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help):
+        return self.add(Counter(self.prefix + name, help))
+
+    def histogram(self, name, help, buckets=BUCKETS):
+        return self.add(Histogram(self.prefix + name, help, buckets))
+
+    def gauge(self, name, help, fn):
+        # replaces an earlier gauge of the same name, e.g. after init() ran again
+        gauge = Gauge(self.prefix + name, help, fn)
+        with self.lock:
+            self.metrics[gauge.name] = gauge
+        return gauge
+
+    @contextmanager
+    def span(self, name, **labels):
+        # times the block into span_seconds{span=name}, exceptions are counted and passed on
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.errors.inc(span=name, **labels)
+            raise
+        finally:
+            self.spans.observe(time.perf_counter() - started, span=name, **labels)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in sorted(metrics, key=lambda metric: metric.name):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# process wide registry, exported on /metrics of the health server
+REGISTRY = Registry()
+span = REGISTRY.span
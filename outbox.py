@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+import telegram
+from telegram.error import BadRequest
+from telegram.error import ChatMigrated
+from telegram.error import NetworkError
+from telegram.error import RetryAfter
+from telegram.error import TelegramError
+from telegram.error import Unauthorized
+
+from metrics import span
+from ratelimit import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+class Job(object):
+    def __init__(self, chat_id, text, reply_markup=None, message_id=None, parse_mode=telegram.ParseMode.MARKDOWN):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        self.reply_markup = reply_markup
+        self.parse_mode = parse_mode
+        self.created = time.monotonic()
+        self.not_before = 0
+        self.attempts = 0
+
+    @property
+    def key(self):
+        return (self.chat_id, self.message_id) if self.message_id is not None else None
+
+
+class Outbox(object):
+    # handlers only enqueue messages, a single sender thread delivers them within Telegram's rate limits
+    def __init__(self, bot, on_unauthorized=None, on_migrated=None, retries=5, backoff=1.0, max_backoff=60.0,
+                 rate=30, chat_interval=1.0, max_edit_age=300, limiter=None):
+        self.bot = bot
+        self.on_unauthorized = on_unauthorized
+        self.on_migrated = on_migrated
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.chat_interval = chat_interval
+        self.max_edit_age = max_edit_age
+        # rate is given in messages per second, limiter replaces that bucket e.g. by one shared between processes
+        self.limiter = limiter if limiter is not None else RateLimiter(rate * 60, burst=rate)
+        self.pending = deque()
+        # pending edits by (chat_id, message_id), newer edits replace the text of the queued one
+        self.edits = dict()
+        # earliest time the next message may go to a chat
+        self.chat_ready = dict()
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.counters = {"sent": 0, "retried": 0, "coalesced": 0, "dropped": 0, "failed": 0}
+        self.thread = threading.Thread(target=self.run, name="outbox", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self, timeout=10):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.thread.join(timeout)
+
+    def send(self, chat_id, text, reply_markup=None, parse_mode=telegram.ParseMode.MARKDOWN):
+        self.put(Job(chat_id, text, reply_markup, parse_mode=parse_mode))
+
+    def edit(self, chat_id, message_id, text, reply_markup=None):
+        self.put(Job(chat_id, text, reply_markup, message_id=message_id))
+
+    def put(self, job):
+        with self.cond:
+            queued = self.edits.get(job.key) if job.key is not None else None
+            if queued is not None:
+                queued.text = job.text
+                queued.reply_markup = job.reply_markup
+                queued.created = job.created
+                self.counters["coalesced"] += 1
+                return
+            if job.key is not None:
+                self.edits[job.key] = job
+            self.pending.append(job)
+            self.cond.notify()
+
+    def stats(self):
+        with self.cond:
+            stats = dict(self.counters)
+            stats["depth"] = len(self.pending)
+            stats["oldest"] = time.monotonic() - min(job.created for job in self.pending) if self.pending else 0
+        return stats
+
+    def run(self):
+        while True:
+            with self.cond:
+                job, wait = self.next_job()
+                if job is None:
+                    if self.stopped:
+                        return
+                    self.cond.wait(wait)
+                    continue
+                self.pending.remove(job)
+                if job.key is not None and self.edits.get(job.key) is job:
+                    del self.edits[job.key]
+            self.limiter.acquire()
+            self.deliver(job)
+
+    def next_job(self):
+        # first job that may go out now, keeping the order of messages within a chat
+        now = time.monotonic()
+        blocked = set()
+        wait = None
+        for job in self.pending:
+            if job.chat_id in blocked:
+                continue
+            ready = max(job.not_before, self.chat_ready.get(job.chat_id, 0))
+            if ready <= now:
+                return job, None
+            blocked.add(job.chat_id)
+            wait = ready - now if wait is None else min(wait, ready - now)
+        return None, wait
+
+    def deliver(self, job):
+        now = time.monotonic()
+        self.chat_ready[job.chat_id] = now + self.chat_interval
+        if len(self.chat_ready) > 1000:
+            self.chat_ready = {chat: ready for chat, ready in self.chat_ready.items() if ready > now}
+        try:
+            if job.message_id is None:
+                with span("telegram_call", method="sendMessage"):
+                    self.bot.sendMessage(chat_id=job.chat_id, text=job.text, reply_markup=job.reply_markup,
+                                         parse_mode=job.parse_mode, disable_web_page_preview=True)
+            else:
+                with span("telegram_call", method="editMessageText"):
+                    self.bot.editMessageText(text=job.text, chat_id=job.chat_id, message_id=job.message_id,
+                                             reply_markup=job.reply_markup, parse_mode=job.parse_mode,
+                                             disable_web_page_preview=True)
+            self.counters["sent"] += 1
+        except RetryAfter as e:
+            self.chat_ready[job.chat_id] = now + e.retry_after
+            self.retry(job, 0)
+        except Unauthorized:
+            self.counters["dropped"] += 1
+            if self.on_unauthorized is not None:
+                self.on_unauthorized(job.chat_id)
+        except ChatMigrated as e:
+            self.counters["dropped"] += 1
+            if self.on_migrated is not None:
+                self.on_migrated(job.chat_id, e.new_chat_id)
+        except BadRequest:
+            # e.g. the message is not modified or was deleted in the meantime
+            self.counters["failed"] += 1
+            logger.warning("Telegram rejected message to %s", job.chat_id, exc_info=True)
+        except NetworkError:
+            delay = min(self.max_backoff, self.backoff * 2 ** job.attempts)
+            self.retry(job, random.uniform(delay / 2, delay))
+        except TelegramError:
+            self.counters["failed"] += 1
+            logger.exception("Sending message to %s failed", job.chat_id)
+
+    def retry(self, job, delay):
+        job.attempts += 1
+        if job.attempts > self.retries or (
+                job.message_id is not None and time.monotonic() - job.created > self.max_edit_age):
+            self.counters["dropped"] += 1
+            logger.warning("Giving up on message to %s after %d attempts", job.chat_id, job.attempts)
+            return
+        job.not_before = time.monotonic() + delay
+        self.counters["retried"] += 1
+        with self.cond:
+            queued = self.edits.get(job.key) if job.key is not None else None
+            if queued is not None:
+                # a newer edit of the same message is already waiting, it replaces this one
+                self.counters["coalesced"] += 1
+                return
+            if job.key is not None:
+                self.edits[job.key] = job
+            self.pending.appendleft(job)
+            self.cond.notify()
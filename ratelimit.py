@@ -0,0 +1,32 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+
+class RateLimiter(object):
+    # token bucket shared by all workers, rate is given in requests per minute
+    def __init__(self, rate, burst=1):
+        self.rate = rate / 60.0
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def try_acquire(self):
+        # takes a token and returns 0, or returns the seconds until the next one without waiting
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+from collections import namedtuple
+from datetime import datetime
+
+# action codes used in callback_data and User.current_selection
+HOME = 0
+SHOW = 1
+START = 2
+DEST = 3
+DATE = 4
+PRICE = 5
+DURATION = 6
+CHANGES = 7
+NOTIFY = 8
+FETCH = 9
+DELETE = 10
+RANGE = 11
+PAGE = 12
+IMPORT = 13
+GROUP = 14
+
+SEPARATOR = "$"
+DATE_FORMAT = "%d.%m.%Y"
+
+# target is the connection id (-1 for a new one), extra the optional third field, already converted
+Payload = namedtuple("Payload", ["action", "target", "extra"])
+
+
+def encode(action, target=None, extra=None):
+    fields = [str(action)]
+    if target is not None:
+        fields.append(str(target))
+        if extra is not None:
+            fields.append(extra.strftime(DATE_FORMAT) if hasattr(extra, "strftime") else str(extra))
+    return SEPARATOR.join(fields)
+
+
+def parse_date(value):
+    return datetime.strptime(value, DATE_FORMAT).date()
+
+
+def page_ref(key, page):
+    return key + "." + str(page)
+
+
+def parse_page(value):
+    # "<key>.<page>" of cached results, the key is a short hex token
+    key, page = value.split(".")
+    if not key.isalnum() or len(key) > 16:
+        raise ValueError("invalid result key %r" % key)
+    page = int(page)
+    if page < 0:
+        raise ValueError("invalid page %d" % page)
+    return key, page
+
+
+def choice(*options):
+    def parse(value):
+        value = int(value)
+        if value not in options:
+            raise ValueError("%d is not one of %s" % (value, options))
+        return value
+    return parse
+
+
+class Router(object):
+    # maps action codes to handlers, payloads are checked completely before a handler runs
+    def __init__(self):
+        self.handlers = dict()
+        self.extras = dict()
+
+    def register(self, action, handler, extra=None):
+        # extra converts the third field of the payload, actions without it don't accept one
+        self.handlers[action] = handler
+        self.extras[action] = extra
+
+    def decode(self, data):
+        fields = data.split(SEPARATOR)
+        if len(fields) > 3:
+            raise ValueError("too many fields in %r" % data)
+        action = int(fields[0])
+        if action not in self.handlers:
+            raise ValueError("unknown action in %r" % data)
+        if action == HOME:
+            return Payload(HOME, None, None)
+        if len(fields) < 2:
+            raise ValueError("missing target in %r" % data)
+        target = int(fields[1])
+        extra = None
+        if len(fields) == 3:
+            if self.extras[action] is None:
+                raise ValueError("unexpected field in %r" % data)
+            extra = self.extras[action](fields[2])
+        return Payload(action, target, extra)
+
+    def dispatch(self, bot, update, usr, payload):
+        return self.handlers[payload.action](bot, update, usr, payload)
@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import logging
+import pickle
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, stored REAL NOT NULL, value BLOB NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS ix_cache_stored ON cache (stored)",
+    "CREATE TABLE IF NOT EXISTS bucket (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)",
+]
+
+
+def shard(chat_id, count):
+    # all updates of a chat go to the same worker, so its selections are handled in order
+    return chat_id % count
+
+
+class SharedStore(object):
+    # small SQLite file next to the database that all worker processes of a host share
+    def __init__(self, path, busy_timeout=5000):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.local = threading.local()
+        with self.transaction() as db:
+            for statement in SCHEMA:
+                db.execute(statement)
+
+    def connect(self):
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path, isolation_level=None, timeout=self.busy_timeout / 1000)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    @contextmanager
+    def transaction(self):
+        # IMMEDIATE takes the write lock at the start, so read-modify-write cycles of processes don't interleave
+        db = self.connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+
+class SharedCache(object):
+    # TTLCache for several processes: a fare looked up by one worker is a hit for all others
+    def __init__(self, store, size=256, ttl=300, max_age=6 * 3600):
+        self.store = store
+        self.size = size
+        self.ttl = ttl
+        # entries older than this are removed, they are no use even as stale results
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+
+    @staticmethod
+    def encode(key):
+        return "|".join(str(part) for part in key)
+
+    def load(self, key, max_age):
+        row = self.store.connect().execute("SELECT value FROM cache WHERE key = ? AND stored > ?",
+                                           (self.encode(key), time.time() - max_age)).fetchone()
+        return pickle.loads(row[0]) if row is not None else None
+
+    def get(self, key):
+        value = self.load(key, self.ttl)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def stale(self, key, max_age):
+        return self.load(key, max_age)
+
+    def __contains__(self, key):
+        return self.store.connect().execute("SELECT 1 FROM cache WHERE key = ? AND stored > ?",
+                                            (self.encode(key), time.time() - self.ttl)).fetchone() is not None
+
+    def put(self, key, value):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.store.transaction() as db:
+            db.execute("INSERT OR REPLACE INTO cache (key, stored, value) VALUES (?, ?, ?)",
+                       (self.encode(key), time.time(), data))
+        with self.lock:
+            self.puts += 1
+            cleanup = self.puts % 100 == 0
+        if cleanup:
+            self.cleanup()
+
+    def cleanup(self):
+        # oldest entries beyond size go first, like the LRU of TTLCache but by age
+        with self.store.transaction() as db:
+            db.execute("DELETE FROM cache WHERE stored <= ?", (time.time() - self.max_age,))
+            db.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY stored DESC LIMIT -1 OFFSET ?)",
+                       (self.size,))
+
+    def stats(self):
+        size = self.store.connect().execute("SELECT count(*) FROM cache").fetchone()[0]
+        with self.lock:
+            total = self.hits + self.misses
+            return {"size": size, "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / total if total else 0.0}
+
+
+class SharedRateLimiter(object):
+    # RateLimiter whose bucket lives in the shared store, so the limit holds for all processes together
+    def __init__(self, store, name, rate, burst=1):
+        self.store = store
+        self.name = name
+        self.rate = rate / 60.0
+        self.burst = burst
+
+    def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def try_acquire(self):
+        with self.store.transaction() as db:
+            now = time.time()
+            row = db.execute("SELECT tokens, updated FROM bucket WHERE name = ?", (self.name,)).fetchone()
+            tokens = self.burst if row is None else min(self.burst, row[0] + max(0, now - row[1]) * self.rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / self.rate
+            if not wait:
+                tokens -= 1
+            db.execute("INSERT OR REPLACE INTO bucket (name, tokens, updated) VALUES (?, ?, ?)",
+                       (self.name, tokens, now))
+            return wait
+
+
+class ShardRouter(object):
+    # front side of the multi-process mode: starts the processes and hands every update to the worker of its chat
+    def __init__(self, context, count, worker, checker, args):
+        # worker(*args, index, count, updates) and checker(*args, stopped) run in their own processes
+        self.count = count
+        self.queues = [context.Queue() for _ in range(count)]
+        self.stopped = context.Event()
+        self.processes = [context.Process(target=worker, args=args + (index, count, self.queues[index]),
+                                          name="worker-%d" % index) for index in range(count)]
+        self.processes.append(context.Process(target=checker, args=args + (self.stopped,), name="checker"))
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+    def forward(self, bot, update):
+        # used as handler callback in the front process, updates travel as the dicts Telegram sent
+        chat = update.effective_chat
+        self.queues[shard(chat.id if chat is not None else 0, self.count)].put(update.to_dict())
+
+    def alive(self):
+        return {process.name: process.is_alive() for process in self.processes}
+
+    def stop(self, timeout=30):
+        for updates in self.queues:
+            updates.put(None)
+        self.stopped.set()
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning("%s did not stop, terminating it", process.name)
+                process.terminate()
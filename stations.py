@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from re import sub
+
+import requests
+
+from cache import TTLCache
+from db import Station
+from db import StationAlias
+from metrics import span
+from upstream import Upstream
+
+STATION_URL = "https://reiseauskunft.bahn.de/bin/ajax-getstop.exe/dn"
+FOLD = str.maketrans({"ä": "ae", "ö": "oe", "ü": "ue", "ß": "ss"})
+
+logger = logging.getLogger(__name__)
+
+
+def normalize(name):
+    name = name.casefold().translate(FOLD)
+    return sub(r'[\W_]+', " ", name).strip()
+
+
+def station_params(name):
+    return {"REQ0JourneyStopsS0A": "1", "REQ0JourneyStopsB": 1, "S": name}
+
+
+def parse_station(text):
+    # the answer is JSONP, the suggestions list sits between the first 23 and the last 23 characters
+    try:
+        return json.loads(text[23:-23])[0]
+    except IndexError:
+        return False
+
+
+class StationFinder(object):
+    # answers station lookups from the local database and only asks ajax-getstop.exe for unknown names
+    def __init__(self, session_factory, url=STATION_URL, upstream=None, workers=4):
+        self.session_factory = session_factory
+        self.url = url
+        self.upstream = upstream if upstream is not None else Upstream("reiseauskunft.bahn.de", read_timeout=5)
+        self.http = requests.Session()
+        # names that are known not to be a station
+        self.unknown = TTLCache(size=1024, ttl=3600)
+        # lookups of a whole watch list, threads are only started once one is imported
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def remote(self, name):
+        with span("station_remote"), self.upstream.request() as timeout:
+            r = self.http.get(self.url, params=station_params(name), timeout=timeout)
+            r.raise_for_status()
+            return parse_station(r.text)
+
+    def find(self, name, s):
+        with span("station_lookup"):
+            return self.lookup(name, s)
+
+    def find_all(self, names):
+        # several names at the same time, each in a session of its own; returns name -> station or False
+        names = list(names)
+        return dict(zip(names, self.executor.map(self.find_alone, names)))
+
+    def find_alone(self, name):
+        s = self.session_factory()
+        try:
+            return self.find(name, s)
+        finally:
+            s.close()
+
+    def lookup(self, name, s):
+        # lookups use the session of the caller, new stations are stored in a session of their own
+        key = normalize(name)
+        if not key:
+            return False
+        station = self.local(s, key)
+        if station is not None:
+            return {"extId": station.ext_id, "value": station.value}
+        if key in self.unknown:
+            return False
+        try:
+            found = self.remote(name)
+        except (requests.RequestException, ValueError):
+            logger.warning("Station lookup for %s failed, trying local prefix match", name, exc_info=True)
+            station = self.prefix(s, key)
+            return {"extId": station.ext_id, "value": station.value} if station is not None else False
+        self.remember(key, found)
+        return found
+
+    def remember(self, key, found):
+        if found:
+            self.store(key, found)
+        else:
+            self.unknown.put(key, True)
+
+    def known(self, key):
+        # whether a lookup of key can be answered without asking ajax-getstop.exe
+        if key in self.unknown:
+            return True
+        s = self.session_factory()
+        try:
+            return self.local(s, key) is not None
+        finally:
+            s.close()
+
+    def local(self, s, key):
+        alias = s.query(StationAlias).filter(StationAlias.name == key).first()
+        if alias is not None:
+            return alias.station
+        return s.query(Station).filter(Station.name == key).first()
+
+    def prefix(self, s, key):
+        # range instead of LIKE, so the index on name is used
+        return s.query(Station).filter(Station.name >= key, Station.name < key + "\uffff") \
+            .order_by(Station.name).first()
+
+    def store(self, key, found):
+        s = self.session_factory()
+        try:
+            station = s.query(Station).filter(Station.ext_id == found["extId"]).first()
+            if station is None:
+                station = Station(ext_id=found["extId"], value=found["value"], name=normalize(found["value"]))
+                s.add(station)
+            if key != station.name:
+                s.merge(StationAlias(name=key, ext_id=station.ext_id))
+            s.commit()
+        except Exception:
+            # another thread stored the same station in the meantime
+            s.rollback()
+        finally:
+            s.close()
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import create_db_engine  # noqa: E402
+from db import migrate  # noqa: E402
+
+
+@pytest.fixture
+def engine(tmp_path):
+    # a migrated bot database in a temporary file
+    engine = create_db_engine("sqlite:///" + str(tmp_path / "bahn.sqlite"))
+    migrate(engine)
+    yield engine
+    engine.dispose()
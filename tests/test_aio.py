@@ -0,0 +1,43 @@
+import threading
+import time
+from collections import namedtuple
+
+from aio import AsyncRuntime
+
+Chat = namedtuple("Chat", ["id"])
+Update = namedtuple("Update", ["update_id", "effective_chat", "callback_query", "message"])
+
+
+def test_updates_of_a_chat_run_in_order():
+    handled = []
+    running = set()
+    overlaps = []
+    lock = threading.Lock()
+
+    def gate(bot, update):
+        chat = update.effective_chat.id
+        with lock:
+            if chat in running:
+                overlaps.append(update.update_id)
+            running.add(chat)
+        # the first update of a chat takes longest, a pool thread that is free would overtake it
+        time.sleep(0.05 if update.update_id % 10 == 0 else 0.001)
+        with lock:
+            running.discard(chat)
+            handled.append((chat, update.update_id))
+
+    runtime = AsyncRuntime(gate, None, None, None, None, db_workers=4)
+    runtime.thread.start()
+    try:
+        futures = [runtime.submit(None, Update(chat * 10 + i, Chat(chat), None, None))
+                   for i in range(5) for chat in (1, 2)]
+        for future in futures:
+            future.result(timeout=5)
+    finally:
+        runtime.loop.call_soon_threadsafe(runtime.loop.stop)
+        runtime.thread.join()
+        runtime.executor.shutdown(wait=True)
+    assert overlaps == []
+    for chat in (1, 2):
+        assert [update_id for c, update_id in handled if c == chat] == [chat * 10 + i for i in range(5)]
+    assert runtime.chats == {}
@@ -0,0 +1,34 @@
+from datetime import date
+from datetime import timedelta
+
+from db import Price
+from history import daily_prices
+
+DAY = date.today() + timedelta(7)
+
+
+def add_prices(engine, day, observed, *cents):
+    with engine.begin() as conn:
+        conn.execute(Price.__table__.insert(), [{"start": "8000261", "dest": "8011160", "day": day, "departure": 480,
+                                                 "klass": 2, "cents": price, "observed": observed} for price in cents])
+
+
+def test_daily_prices_min_and_median(engine):
+    today = date.today()
+    add_prices(engine, DAY, today, 4990, 1990, 2990)
+    add_prices(engine, DAY + timedelta(1), today, 3990, 1790, 5990, 2590)
+    # older observations and other days are left out
+    add_prices(engine, DAY, today - timedelta(10), 990)
+    add_prices(engine, DAY + timedelta(2), today, 990)
+    with engine.connect() as conn:
+        days = daily_prices(conn, "8000261", "8011160", DAY, DAY + timedelta(1), since=today - timedelta(1))
+    assert list(days.items()) == [(DAY, (1990, 2990)), (DAY + timedelta(1), (1790, 3290))]
+
+
+def test_daily_prices_need_no_sorting(engine):
+    with engine.connect() as conn:
+        plan = " ".join(row[-1] for row in conn.execute(
+            "EXPLAIN QUERY PLAN SELECT day, cents FROM price WHERE start = ? AND dest = ? AND day BETWEEN ? AND ? "
+            "AND observed >= ? ORDER BY day, cents", ("8000261", "8011160", DAY, DAY, DAY)))
+    assert "ix_price_route" in plan
+    assert "TEMP B-TREE" not in plan
@@ -0,0 +1,106 @@
+from collections import namedtuple
+
+import pytest
+from sqlalchemy import select
+
+import jobs
+from db import Job
+from jobs import DEAD
+from jobs import DONE
+from jobs import READY
+from jobs import JobQueue
+from watcher import INTERVALS
+from watcher import is_due
+from watcher import job_key
+from watcher import slot
+
+Conn = namedtuple("Conn", ["id", "notifications"])
+
+
+class Clock(object):
+    # stands in for the time module in jobs
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(jobs, "time", clock)
+    return clock
+
+
+def states(engine):
+    table = Job.__table__
+    with engine.connect() as conn:
+        return dict(conn.execute(select([table.c.key, table.c.state])).fetchall())
+
+
+def test_expired_lease_is_leased_again(engine, clock):
+    queue = JobQueue(engine, visibility=10, attempts=2)
+    queue.enqueue([("a", {"connection": 1})])
+    first = queue.lease(5)
+    assert [(job.key, job.payload, job.attempts) for job in first] == [("a", {"connection": 1}, 1)]
+    # invisible while leased
+    assert queue.lease(5) == []
+    # the worker died, the lease runs out
+    clock.now += 10
+    second = queue.lease(5)
+    assert [(job.id, job.attempts) for job in second] == [(first[0].id, 2)]
+    # no attempts left after the second lease ran out as well
+    clock.now += 10
+    assert queue.lease(5) == []
+    assert states(engine) == {"a": DEAD}
+
+
+def test_failed_job_backs_off_until_dead(engine, clock):
+    queue = JobQueue(engine, attempts=3, backoff=10)
+    queue.enqueue([("a", {})])
+    for attempt, backoff in ((1, 10), (2, 20)):
+        job, = queue.lease(5)
+        assert job.attempts == attempt
+        queue.fail([job])
+        clock.now += backoff - 1
+        assert queue.lease(5) == []
+        clock.now += 1
+    job, = queue.lease(5)
+    assert job.attempts == 3
+    queue.fail([job])
+    assert states(engine) == {"a": DEAD}
+    clock.now += 3600
+    assert queue.lease(5) == []
+
+
+def test_release_does_not_count_the_attempt(engine, clock):
+    queue = JobQueue(engine, attempts=1)
+    queue.enqueue([("a", {})])
+    job, = queue.lease(5)
+    queue.release([job])
+    # available at once, and still allowed its one attempt
+    job, = queue.lease(5)
+    assert job.attempts == 1
+    queue.done([job])
+    queue.flush()
+    assert states(engine) == {"a": DONE}
+
+
+def test_check_is_queued_once_per_interval(engine, clock):
+    queue = JobQueue(engine)
+    conn = Conn(7, 2)
+    interval = INTERVALS[conn.notifications]
+    offset = slot(conn.id, interval)
+    # first and last second of the interval around now
+    first = offset + (clock.now - offset) // interval * interval
+    last = first + interval - 1
+    assert not is_due(conn, first, last)
+    queue.enqueue([(job_key(conn, first), {"connection": conn.id})])
+    # queued again later in the same interval, e.g. after a restart
+    queue.enqueue([(job_key(conn, last), {"connection": conn.id})])
+    assert list(states(engine).values()) == [READY]
+    # the next interval is a new check
+    assert is_due(conn, last, last + 1)
+    queue.enqueue([(job_key(conn, last + 1), {"connection": conn.id})])
+    assert list(states(engine).values()) == [READY, READY]
@@ -0,0 +1,84 @@
+from datetime import date
+from datetime import timedelta
+
+from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker
+
+from db import ArchivedConnection
+from db import Connection
+from db import Price
+from db import User
+from db import migrate
+from maintenance import purge
+from maintenance import purge_prices
+
+OLD = date.today() - timedelta(3)
+
+
+def add_connection(session_factory, day, id=None):
+    s = session_factory()
+    conn = Connection(id=id, user_id=1, date=day, start="8000261", start_name="München Hbf", dest="8011160",
+                      dest_name="Berlin Hbf", notifications=0)
+    s.add(conn)
+    s.commit()
+    id = conn.id
+    s.close()
+    return id
+
+
+def archived_ids(engine):
+    with engine.connect() as conn:
+        return sorted(row[0] for row in conn.execute(select([ArchivedConnection.__table__.c.id])))
+
+
+def test_archived_ids_are_not_reused(engine):
+    session_factory = sessionmaker(bind=engine)
+    s = session_factory()
+    s.add(User(id=1, counter=0))
+    s.commit()
+    s.close()
+    first = add_connection(session_factory, OLD)
+    assert purge(engine)["archived"] == 1
+    # the archived connection had the highest id
+    second = add_connection(session_factory, OLD)
+    assert second != first
+    assert purge(engine)["archived"] == 1
+    assert archived_ids(engine) == [first, second]
+
+
+def test_migration_moves_reused_ids(engine):
+    # a database from before AUTOINCREMENT, connection 1 got the id of an archived connection
+    with engine.begin() as conn:
+        conn.execute("DROP TABLE connection")
+        conn.execute("CREATE TABLE connection (id INTEGER NOT NULL PRIMARY KEY, date DATE NOT NULL, "
+                     "start VARCHAR(9) NOT NULL, start_name VARCHAR(250) NOT NULL, dest VARCHAR(9) NOT NULL, "
+                     "dest_name VARCHAR(250) NOT NULL, maxduration INTEGER, maxchanges INTEGER, maxprice FLOAT, "
+                     "notifications INTEGER, notified_hash VARCHAR(16), notified_cents INTEGER, start_group TEXT, "
+                     "dest_group TEXT, user_id INTEGER, FOREIGN KEY(user_id) REFERENCES user (id))")
+        conn.execute("INSERT INTO user (id, counter) VALUES (1, 0)")
+        conn.execute("INSERT INTO connection_archive (id, date, start, start_name, dest, dest_name, user_id) "
+                     "VALUES (1, '2020-01-01', '8000261', 'München Hbf', '8011160', 'Berlin Hbf', 1), "
+                     "(3, '2020-01-01', '8000261', 'München Hbf', '8011160', 'Berlin Hbf', 1)")
+        conn.execute("INSERT INTO connection (id, date, start, start_name, dest, dest_name, user_id) "
+                     "VALUES (1, '%s', '8000261', 'München Hbf', '8011160', 'Berlin Hbf', 1), "
+                     "(2, '%s', '8000261', 'München Hbf', '8011160', 'Berlin Hbf', 1)" % (OLD, OLD))
+        conn.execute("PRAGMA user_version=3")
+    migrate(engine)
+    with engine.connect() as conn:
+        assert sorted(row[0] for row in conn.execute("SELECT id FROM connection")) == [2, 4]
+    session_factory = sessionmaker(bind=engine)
+    assert add_connection(session_factory, OLD) == 5
+    # the purge that failed on the duplicate id goes through
+    assert purge(engine)["archived"] == 3
+    assert archived_ids(engine) == [1, 2, 3, 4, 5]
+
+
+def test_old_prices_are_purged_in_batches(engine):
+    today = date.today()
+    rows = [{"start": "8000261", "dest": "8011160", "day": today, "departure": 480, "klass": 2, "cents": 1990,
+             "observed": observed} for observed in [today - timedelta(100)] * 5 + [today - timedelta(10)] * 2]
+    with engine.begin() as conn:
+        conn.execute(Price.__table__.insert(), rows)
+    assert purge_prices(engine, retention=90, batch=2, pause=0) == {"deleted": 5, "batches": 3}
+    with engine.connect() as conn:
+        assert conn.execute("SELECT count(*) FROM price").scalar() == 2
@@ -0,0 +1,80 @@
+import json
+from collections import namedtuple
+from datetime import date
+from datetime import timedelta
+
+import pytest
+from sqlalchemy.orm import scoped_session
+from sqlalchemy.orm import sessionmaker
+
+import daemon
+from db import Connection
+from db import User
+from router import RANGE
+from router import Payload
+
+Chat = namedtuple("Chat", ["id"])
+Message = namedtuple("Message", ["chat", "message_id"])
+CallbackQuery = namedtuple("CallbackQuery", ["message"])
+Update = namedtuple("Update", ["callback_query", "message"])
+
+
+class Outbox(object):
+    def __init__(self):
+        self.edited = []
+
+    def edit(self, chat_id, message_id, text, reply_markup=None):
+        self.edited.append(text)
+
+
+class Fares(object):
+    def __init__(self):
+        self.searched = []
+
+    def fetch_range(self, starts, dests, days, callback):
+        self.searched.append((starts, dests, len(days)))
+
+
+@pytest.fixture
+def search(engine, monkeypatch):
+    # SearchRange of a connection with two start and two destination stations, returns what was searched
+    session = scoped_session(sessionmaker(bind=engine, autoflush=False))
+    s = session()
+    s.add(User(id=1, counter=0))
+    s.add(Connection(id=1, user_id=1, date=date.today() + timedelta(7), start="8000261", start_name="München Hbf",
+                     dest="8011160", dest_name="Berlin Hbf", notifications=0,
+                     start_group=json.dumps([["8000262", "München Ost"]]),
+                     dest_group=json.dumps([["8011113", "Berlin Südkreuz"]])))
+    s.commit()
+    session.remove()
+    outbox, fares = Outbox(), Fares()
+    monkeypatch.setattr(daemon, "DBSession", session)
+    monkeypatch.setattr(daemon, "outbox", outbox)
+    monkeypatch.setattr(daemon, "fares", fares)
+
+    def search(days):
+        update = Update(CallbackQuery(Message(Chat(1), 10)), None)
+        daemon.SearchRange(None, update, User(id=1), Payload(RANGE, 1, days))
+        session.remove()
+        return fares.searched[-1], outbox.edited[-1]
+
+    return search
+
+
+def test_week_searches_the_whole_group(search):
+    (starts, dests, days), text = search(7)
+    assert (starts, dests, days) == (["8000261", "8000262"], ["8011160", "8011113"], 7)
+    assert "ohne die weiteren" not in text
+
+
+def test_four_weeks_search_the_connection_only(search):
+    (starts, dests, days), text = search(28)
+    assert (starts, dests, days) == (["8000261"], ["8011160"], 28)
+    assert "ohne die weiteren" in text
+
+
+def test_range_lookups_are_capped():
+    groups = ["a", "b", "c", "d"]
+    assert daemon.range_fits(["a"], ["b"], 28)
+    assert daemon.range_fits(groups[:2], groups[2:], 7)
+    assert not daemon.range_fits(groups, ["e", "f", "g", "h"], 7)
@@ -0,0 +1,80 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from ratelimit import RateLimiter
+from upstream import CLOSED
+from upstream import HALF_OPEN
+from upstream import Upstream
+
+
+class LockedLimiter(RateLimiter):
+    # fails once, like SharedRateLimiter when its database is locked
+    def __init__(self):
+        RateLimiter.__init__(self, 6000, burst=10)
+        self.locked = True
+
+    def check(self):
+        if self.locked:
+            self.locked = False
+            raise sqlite3.OperationalError("database is locked")
+
+    def acquire(self):
+        self.check()
+        RateLimiter.acquire(self)
+
+    def try_acquire(self):
+        self.check()
+        return RateLimiter.try_acquire(self)
+
+
+def half_open(limiter=None):
+    upstream = Upstream("bahn", failures=1, reset=0, limiter=limiter)
+    upstream.breaker.failure()
+    return upstream
+
+
+def test_failed_limiter_releases_the_probe():
+    upstream = half_open(LockedLimiter())
+    with pytest.raises(sqlite3.OperationalError):
+        with upstream.request():
+            pass
+    assert upstream.breaker.state == HALF_OPEN
+    assert not upstream.breaker.probing
+    assert upstream.limit.inflight == 0
+    with upstream.request():
+        pass
+    assert upstream.breaker.state == CLOSED
+
+
+def test_failed_limiter_releases_the_probe_async():
+    upstream = half_open(LockedLimiter())
+
+    async def probe():
+        async with upstream.request_async():
+            pass
+
+    with pytest.raises(sqlite3.OperationalError):
+        asyncio.run(probe())
+    assert not upstream.breaker.probing
+    assert upstream.limit.inflight == 0
+    asyncio.run(probe())
+    assert upstream.breaker.state == CLOSED
+
+
+def test_cancelled_wait_releases_the_probe():
+    # the only token is gone, so the probe waits for the next one and is cancelled meanwhile
+    upstream = half_open(RateLimiter(1, burst=1))
+    upstream.limiter.try_acquire()
+
+    async def probe():
+        task = asyncio.ensure_future(upstream.request_async().__aenter__())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(probe())
+    assert not upstream.breaker.probing
+    assert upstream.limit.inflight == 0
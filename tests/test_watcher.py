@@ -0,0 +1,90 @@
+import time
+from datetime import date
+from datetime import timedelta
+from decimal import Decimal
+
+from sqlalchemy.orm import sessionmaker
+
+from bahn import Fare
+from db import Connection
+from db import User
+from jobs import JobQueue
+from watcher import INTERVALS
+from watcher import Watcher
+from watcher import offer_set
+
+
+class Outbox(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, chat_id, text, reply_markup=None):
+        self.sent.append((chat_id, text))
+
+
+def fare(start_time, price):
+    return Fare(start_time, "12:00", 180, 0, Decimal(price), "2", None)
+
+
+def make_watcher(engine, fares):
+    session_factory = sessionmaker(bind=engine)
+    s = session_factory()
+    s.add(User(id=1, counter=0))
+    s.add(Connection(id=1, user_id=1, date=date.today() + timedelta(7), start="8000261", start_name="München Hbf",
+                     dest="8011160", dest_name="Berlin Hbf", notifications=2))
+    s.commit()
+    s.close()
+    watcher = Watcher(Outbox(), session_factory, lambda starts, dests, day: fares,
+                      lambda conn, entries: sorted(entries), JobQueue(engine))
+    return watcher, session_factory
+
+
+def connection(session_factory):
+    s = session_factory()
+    conn = s.query(Connection).get(1)
+    s.expunge(conn)
+    s.close()
+    return conn
+
+
+def test_offer_set_skips_unpriced_fares():
+    entries = {Decimal(0): [fare("06:00", 0)], Decimal("19.90"): [fare("08:00", "19.90")]}
+    assert offer_set(entries) == {(480, "2"): 1990}
+
+
+def test_unpriced_fares_dont_hide_cheaper_offers(engine):
+    fares = [fare("06:00", 0), fare("07:00", 0), fare("08:00", "29.90")]
+    watcher, session_factory = make_watcher(engine, fares)
+    assert watcher.check(["8000261"], ["8011160"], date.today(), [connection(session_factory)])
+    # only the priced fare is shown and remembered
+    assert watcher.outbox.sent == [(1, [Decimal("29.90")])]
+    assert connection(session_factory).notified_cents == 2990
+    fares.append(fare("09:00", "19.90"))
+    assert watcher.check(["8000261"], ["8011160"], date.today(), [connection(session_factory)])
+    assert watcher.outbox.sent[-1] == (1, [Decimal("19.90"), Decimal("29.90")])
+    assert connection(session_factory).notified_cents == 1990
+
+
+def test_no_notification_without_priced_offers(engine):
+    watcher, session_factory = make_watcher(engine, [fare("06:00", 0), fare("07:00", 0)])
+    assert watcher.check(["8000261"], ["8011160"], date.today(), [connection(session_factory)])
+    assert watcher.outbox.sent == []
+    assert connection(session_factory).notified_cents is None
+
+
+def test_removed_users_are_not_checked(engine, monkeypatch):
+    import daemon
+    watcher, session_factory = make_watcher(engine, [])
+    now = time.time()
+    assert [conn.id for conn in watcher.due(now - INTERVALS[2], now)] == [1]
+    monkeypatch.setattr(daemon, "SessionFactory", session_factory)
+    daemon.RemoveUser(1)
+    s = session_factory()
+    assert s.query(Connection).count() == 0
+    # a connection left behind by an older version has no user anymore
+    s.add(Connection(id=2, user_id=None, date=date.today() + timedelta(7), start="8000261", start_name="München Hbf",
+                     dest="8011160", dest_name="Berlin Hbf", notifications=2))
+    s.commit()
+    s.close()
+    assert watcher.due(now - INTERVALS[2], now) == []
+    assert watcher.load([1, 2]) == {}
@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import threading
+import time
+from contextlib import asynccontextmanager
+from contextlib import contextmanager
+
+import requests
+
+from metrics import REGISTRY
+from ratelimit import RateLimiter
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+logger = logging.getLogger(__name__)
+rejected = REGISTRY.counter("upstream_rejected_total", "Requests not sent because the circuit breaker was open")
+failed = REGISTRY.counter("upstream_failures_total", "Requests that failed or timed out")
+
+
+class UpstreamUnavailable(requests.RequestException):
+    # raised instead of sending a request while the circuit breaker is open
+    pass
+
+
+class CircuitBreaker(object):
+    # opens after failures consecutive failures, after reset seconds a single request may try again
+    def __init__(self, failures=5, reset=30):
+        self.failures = failures
+        self.reset = reset
+        self.state = CLOSED
+        self.count = 0
+        self.opened = 0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == OPEN and time.monotonic() >= self.opened + self.reset:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN:
+                if self.probing:
+                    return False
+                self.probing = True
+                return True
+            return self.state == CLOSED
+
+    def success(self):
+        with self.lock:
+            self.state = CLOSED
+            self.count = 0
+            self.probing = False
+
+    def release(self):
+        # the probe was let through but never sent, e.g. the rate limiter failed; the next request probes instead
+        with self.lock:
+            self.probing = False
+
+    def failure(self):
+        with self.lock:
+            self.count += 1
+            self.probing = False
+            if self.state == HALF_OPEN or self.count >= self.failures:
+                if self.state != OPEN:
+                    logger.warning("Circuit breaker opened after %d failures", self.count)
+                self.state = OPEN
+                self.opened = time.monotonic()
+
+
+class AdaptiveLimit(object):
+    # concurrent requests, grows by one per limit successful requests and is halved on failures (AIMD)
+    def __init__(self, initial=8, minimum=1, maximum=16, cooldown=1.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        # failures of requests that were already running when the limit was cut don't cut it again
+        self.cooldown = cooldown
+        self.decreased = 0
+        self.inflight = 0
+        self.cond = threading.Condition()
+
+    def try_enter(self):
+        with self.cond:
+            if self.inflight >= int(self.limit):
+                return False
+            self.inflight += 1
+            return True
+
+    def enter(self):
+        with self.cond:
+            while self.inflight >= int(self.limit):
+                self.cond.wait()
+            self.inflight += 1
+
+    def leave(self, ok):
+        with self.cond:
+            self.inflight -= 1
+            if ok:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            elif time.monotonic() >= self.decreased + self.cooldown:
+                self.limit = max(self.minimum, self.limit / 2)
+                self.decreased = time.monotonic()
+            self.cond.notify_all()
+
+
+class Upstream(object):
+    # guards every request to one remote service: timeouts, a token bucket, the adaptive concurrency limit and a
+    # circuit breaker, shared by interactive lookups and background checks
+    def __init__(self, name, rate=600, burst=10, concurrency=8, failures=5, reset=30, connect_timeout=3.05,
+                 read_timeout=10, limiter=None):
+        # limiter replaces the token bucket of rate and burst, e.g. by one shared between processes
+        self.name = name
+        self.timeout = (connect_timeout, read_timeout)
+        self.limiter = limiter if limiter is not None else RateLimiter(rate, burst=burst)
+        self.limit = AdaptiveLimit(initial=concurrency, maximum=concurrency * 2)
+        self.breaker = CircuitBreaker(failures, reset)
+
+    def admit(self):
+        if not self.breaker.allow():
+            rejected.inc(upstream=self.name)
+            raise UpstreamUnavailable("%s is unavailable" % self.name)
+
+    def abandon(self):
+        # a request that was admitted but failed or was cancelled before it was sent
+        self.breaker.release()
+
+    def done(self, ok):
+        self.limit.leave(ok)
+        if ok:
+            self.breaker.success()
+        else:
+            failed.inc(upstream=self.name)
+            self.breaker.failure()
+
+    @contextmanager
+    def request(self):
+        # any exception in the block counts as a failure of the service
+        self.admit()
+        try:
+            self.limiter.acquire()
+            self.limit.enter()
+        except BaseException:
+            self.abandon()
+            raise
+        ok = False
+        try:
+            yield self.timeout
+            ok = True
+        finally:
+            self.done(ok)
+
+    @asynccontextmanager
+    async def request_async(self):
+        # same as request for coroutines, waiting without blocking the event loop
+        self.admit()
+        try:
+            wait = self.limiter.try_acquire()
+            while wait:
+                await asyncio.sleep(wait)
+                wait = self.limiter.try_acquire()
+            while not self.limit.try_enter():
+                await asyncio.sleep(0.05)
+        except BaseException:
+            # also when the coroutine is cancelled while it waits
+            self.abandon()
+            raise
+        ok = False
+        try:
+            yield self.timeout
+            ok = True
+        finally:
+            self.done(ok)
+
+    def stats(self):
+        return {"state": self.breaker.state, "limit": self.limit.limit, "inflight": self.limit.inflight}
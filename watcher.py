@@ -0,0 +1,258 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+from telegram import InlineKeyboardButton
+from telegram import InlineKeyboardMarkup
+
+from bahn import UNAVAILABLE
+from bahn import filter_fares
+from bahn import timetomin
+from db import Connection
+from db import dest_group
+from db import start_group
+from db import station_ids
+from ratelimit import RateLimiter
+from router import SHOW
+from router import encode
+
+# seconds between two checks, indexed by Connection.notifications (0 = none, 1 = weekly, 2 = daily)
+INTERVALS = {1: 7 * 24 * 3600, 2: 24 * 3600}
+# fractional part of the golden ratio, spreads consecutive ids evenly over the interval
+SPREAD = 0.6180339887498949
+
+logger = logging.getLogger(__name__)
+
+
+def slot(conn_id, interval):
+    # offset of the check inside its interval, so checks don't all fire at midnight
+    return int((conn_id * SPREAD) % 1 * interval)
+
+
+def offer_set(entries):
+    # (departure, class) -> price in cents of all offers within the limits of the user; fares without a Sparpreis
+    # come with price 0 and are no offer
+    return {(timetomin(fare.start_time), fare.klass): int(fare.price * 100)
+            for fares in entries.values() for fare in fares if fare.price}
+
+
+def priced(entries):
+    # the buckets of filter_fares without the unpriced fares, or its error message
+    if type(entries) is str:
+        return entries
+    return {price: fares for price, fares in entries.items() if price}
+
+
+def fingerprint(offers):
+    data = ";".join("%d,%s,%d" % (departure, klass, cents) for (departure, klass), cents in sorted(offers.items()))
+    return hashlib.blake2b(data.encode(), digest_size=8).hexdigest()
+
+
+def is_due(conn, last, now):
+    interval = INTERVALS.get(conn.notifications)
+    if interval is None:
+        return False
+    offset = slot(conn.id, interval)
+    return (now - offset) // interval > (last - offset) // interval
+
+
+def job_key(conn, now):
+    # one check per connection and interval, queueing it again in the same interval adds nothing
+    interval = INTERVALS[conn.notifications]
+    return "check:%d:%d:%d" % (conn.id, interval, (now - slot(conn.id, interval)) // interval)
+
+
+class Watcher(object):
+    # due checks are queued as jobs (see jobs.JobQueue) and leased from there, so checks that were queued or
+    # running when the process stopped are done after the restart, and finished ones are not repeated
+    def __init__(self, outbox, session_factory, fetch, render, queue, workers=4, rate=30, tick=60, drop=0):
+        self.outbox = outbox
+        self.session_factory = session_factory
+        self.fetch = fetch
+        self.render = render
+        self.queue = queue
+        # jobs leased but not finished yet, at most batch of them
+        self.leased = 0
+        self.batch = workers * 8
+        self.tick = tick
+        # minimum price drop in cents of an already notified offer that is worth another message
+        self.drop = drop
+        # offers of the last notification per connection id, compared against the stored fingerprint
+        self.notified = dict()
+        self.lock = threading.Lock()
+        self.limiter = RateLimiter(rate)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # upstream lookups done and saved by sharing a route/date between connections
+        self.fetches = 0
+        self.saved_fetches = 0
+        self.last_saved = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="watcher", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.executor.shutdown(wait=True)
+        self.queue.flush()
+
+    def run(self):
+        # the first round looks back a whole interval: checks that fell into a downtime are queued, unless
+        # their job of this interval is finished already
+        last = time.time() - max(INTERVALS.values())
+        while True:
+            now = time.time()
+            try:
+                self.enqueue(self.due(last, now), now)
+            except Exception:
+                logger.exception("Selecting due connections failed")
+            last = now
+            try:
+                with self.lock:
+                    free = self.batch - self.leased
+                self.schedule(self.queue.lease(free))
+            except Exception:
+                logger.exception("Leasing checks failed")
+            self.queue.flush()
+            if self.stopped.wait(self.tick):
+                return
+
+    def due(self, last, now):
+        s = self.session_factory()
+        try:
+            # connections of removed users are skipped until they are purged
+            conns = s.query(Connection).filter(Connection.notifications > 0, Connection.user_id.isnot(None),
+                                               Connection.date >= date.today()).all()
+            due = [conn for conn in conns if is_due(conn, last, now)]
+            for conn in due:
+                s.expunge(conn)
+            return due
+        finally:
+            s.close()
+
+    def enqueue(self, conns, now):
+        self.queue.enqueue([(job_key(conn, now), {"connection": conn.id}) for conn in conns])
+
+    def load(self, ids):
+        # connections of leased jobs as they are now, deleted ones, those of removed users and those without
+        # notifications are missing
+        s = self.session_factory()
+        try:
+            conns = s.query(Connection).filter(Connection.id.in_(ids), Connection.notifications > 0,
+                                               Connection.user_id.isnot(None), Connection.date >= date.today()).all()
+            for conn in conns:
+                s.expunge(conn)
+            return {conn.id: conn for conn in conns}
+        finally:
+            s.close()
+
+    def schedule(self, jobs):
+        # connections on the same route (or station groups) and day share one upstream lookup
+        if not jobs:
+            return
+        conns = self.load([job.payload["connection"] for job in jobs])
+        groups = dict()
+        for job in jobs:
+            conn = conns.get(job.payload["connection"])
+            if conn is None:
+                # nothing to check anymore
+                self.queue.done([job])
+                continue
+            key = (tuple(station_ids(start_group(conn))), tuple(station_ids(dest_group(conn))), conn.date)
+            group = groups.setdefault(key, ([], []))
+            group[0].append(conn)
+            group[1].append(job)
+        checked = sum(len(group[0]) for group in groups.values())
+        self.fetches += len(groups)
+        self.last_saved = checked - len(groups)
+        self.saved_fetches += self.last_saved
+        logger.info("Checking %d connections with %d lookups, %d saved", checked, len(groups), self.last_saved)
+        for (starts, dests, day), (group, leases) in groups.items():
+            with self.lock:
+                self.leased += len(leases)
+            self.executor.submit(self.run_check, starts, dests, day, group, leases)
+
+    def run_check(self, starts, dests, day, conns, jobs):
+        # the jobs are done once the users are notified, failed lookups are tried again later
+        try:
+            if self.stopped.is_set():
+                self.queue.release(jobs)
+            elif self.check(starts, dests, day, conns):
+                self.queue.done(jobs)
+            else:
+                self.queue.fail(jobs)
+        except Exception:
+            logger.exception("Finishing checks of %s - %s on %s failed", "|".join(starts), "|".join(dests), day)
+        finally:
+            with self.lock:
+                self.leased -= len(jobs)
+
+    def check(self, starts, dests, day, conns):
+        # False if the Bahn couldn't be asked, so the check should be repeated
+        self.limiter.acquire()
+        try:
+            fares = self.fetch(starts, dests, day)
+        except Exception:
+            logger.exception("Fetching %s - %s on %s failed", "|".join(starts), "|".join(dests), day)
+            return False
+        if fares == UNAVAILABLE:
+            return False
+        changed = dict()
+        for conn in conns:
+            entries = priced(filter_fares(fares, conn))
+            if type(entries) is str or not entries:
+                # nothing within the limits of the user, so don't bother them
+                continue
+            offers = offer_set(entries)
+            digest = fingerprint(offers)
+            if self.is_news(conn, offers, digest):
+                self.notify(conn, entries, offers, digest)
+                changed[conn.id] = (digest, min(offers.values()))
+        if changed:
+            self.remember(changed)
+        return True
+
+    def is_news(self, conn, offers, digest):
+        # only a new offer below the last cheapest price or a big enough drop of a known offer is news
+        if conn.notified_hash is None:
+            return True
+        if digest == conn.notified_hash:
+            return False
+        with self.lock:
+            previous = self.notified.get(conn.id)
+        if previous is None or previous[0] != conn.notified_hash:
+            # restarted since the last notification, only the cheapest price is known
+            return min(offers.values()) <= conn.notified_cents - max(self.drop, 1)
+        for key, cents in offers.items():
+            if key not in previous[1]:
+                if cents < conn.notified_cents:
+                    return True
+            elif cents <= previous[1][key] - max(self.drop, 1):
+                return True
+        return False
+
+    def remember(self, changed):
+        s = self.session_factory()
+        try:
+            for conn_id, (notified_hash, notified_cents) in changed.items():
+                s.query(Connection).filter(Connection.id == conn_id).update(
+                    {"notified_hash": notified_hash, "notified_cents": notified_cents}, synchronize_session=False)
+            s.commit()
+        except Exception:
+            s.rollback()
+            logger.exception("Storing notified offers failed")
+        finally:
+            s.close()
+
+    def notify(self, conn, entries, offers, digest):
+        with self.lock:
+            self.notified[conn.id] = (digest, offers)
+        button_list = [[InlineKeyboardButton("🚄 Verbindung", callback_data=encode(SHOW, conn.id))]]
+        self.outbox.send(conn.user_id, self.render(conn, entries), InlineKeyboardMarkup(button_list))
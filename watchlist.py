@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import re
+from collections import namedtuple
+from decimal import Decimal
+
+from db import GROUP_SIZE
+from router import parse_date
+
+# more lines are refused, so one message can't start hundreds of station lookups
+MAX_WATCHES = 50
+
+# one connection to create, start and dest are tuples of the station names the user typed, the first one of a
+# group is the station of the connection
+Watch = namedtuple("Watch", ["line", "start", "dest", "date", "maxprice", "maxduration", "maxchanges"])
+
+LINE = re.compile(r"^(?P<route>.+?)\s+(?P<date>\d{1,2}\.\d{1,2}\.\d{4})(?P<limits>(?:\s+\S+)*)\s*$")
+# " - ", "–" and "→" separate stations whose names contain a hyphen, a plain "-" is enough for short names
+WIDE_SEPARATOR = re.compile(r"\s+-\s+|\s*[–→>]\s*")
+PRICE = re.compile(r"^<=?(\d+(?:[.,]\d{1,2})?)€?$")
+DURATION = re.compile(r"^<=?(\d+)(h|min)$")
+CHANGES = re.compile(r"^<=?(\d+)x$")
+COMMAND = re.compile(r"^/import(@\w+)?(?=\s|$)")
+
+
+def is_import(text):
+    return COMMAND.match(text) is not None
+
+
+def strip_command(text):
+    # the list may follow "/import" (or "/import@botname") in the same message
+    return COMMAND.sub("", text).strip()
+
+
+def split_route(route):
+    # "Berlin Hbf|Berlin Südkreuz" is a station group
+    stations = WIDE_SEPARATOR.split(route) if WIDE_SEPARATOR.search(route) else route.split("-")
+    return [tuple(name.strip() for name in station.split("|")) for station in stations]
+
+
+def parse_limits(text):
+    # "<40€", "<5h" or "<90min" and "<2x", in any order; the connection defaults apply to missing ones
+    maxprice = maxduration = maxchanges = None
+    for token in text.split():
+        price, duration, changes = PRICE.match(token), DURATION.match(token), CHANGES.match(token)
+        if price:
+            maxprice = Decimal(price.group(1).replace(",", ".")).quantize(Decimal('.01'))
+        elif duration:
+            maxduration = int(duration.group(1)) * (60 if duration.group(2) == "h" else 1)
+        elif changes:
+            maxchanges = int(changes.group(1))
+        else:
+            raise ValueError("unbekannte Angabe " + token)
+    return maxprice, maxduration, maxchanges
+
+
+def parse_line(line, today):
+    # a route over several stations becomes one watch per leg, all on the same day
+    match = LINE.match(line)
+    if not match:
+        raise ValueError("Format ist Start-Ziel TT.MM.JJJJ")
+    stations = split_route(match.group("route"))
+    if len(stations) < 2 or not all(all(group) for group in stations):
+        raise ValueError("Start und Ziel fehlen")
+    if any(len(group) > GROUP_SIZE for group in stations):
+        raise ValueError("höchstens %d Bahnhöfe je Gruppe" % GROUP_SIZE)
+    try:
+        day = parse_date(match.group("date"))
+    except ValueError:
+        raise ValueError("ungültiges Datum")
+    if day < today:
+        raise ValueError("Datum liegt in der Vergangenheit")
+    limits = parse_limits(match.group("limits"))
+    return [Watch(line, start, dest, day, *limits) for start, dest in zip(stations, stations[1:])]
+
+
+def parse_watchlist(text, today):
+    # returns the watches and (line, reason) of every line that can't be used, empty lines are skipped
+    watches = []
+    errors = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            watches.extend(parse_line(line, today))
+        except ValueError as e:
+            errors.append((line, str(e)))
+    if len(watches) > MAX_WATCHES:
+        errors.append(("", "höchstens %d Verbindungen auf einmal" % MAX_WATCHES))
+    return watches, errors
+
+
+def station_names(watches):
+    # every name once, in the order of the list
+    return list(dict.fromkeys(name for watch in watches for name in watch.start + watch.dest))